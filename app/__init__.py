@@ -8,9 +8,6 @@ from config import Config
 def get_logger(logger_name=None) -> Logger:
     logger_name = logger_name or __name__
     logger = logging.getLogger(logger_name)
-    print(f"logger_name: {logger_name}")
-
-    print(f"SERVER_SOFTWARE: {os.environ.get('SERVER_SOFTWARE', '')}")
     # configure logging
     # check if fastapi app is served by gunicorn
     if "gunicorn" in os.environ.get("SERVER_SOFTWARE", ""):
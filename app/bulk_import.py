@@ -0,0 +1,197 @@
+# streaming bulk import of todos from ndjson or csv
+#
+# the input is parsed line by line and inserted in chunks of
+# Config.IMPORT_CHUNK_SIZE rows, one transaction per chunk, so memory stays
+# flat whatever the input size:
+# - postgresql (psycopg2): COPY ... FROM STDIN of the chunk as csv
+# - other databases: one executemany insert of the chunk
+#
+# ndjson lines and csv rows (with a header line) have the TodoCreate fields,
+# and optionally an owner_id. invalid rows are skipped and reported.
+#
+# used by the POST /api/v1/todos/import endpoint, and as a cli for
+# onboarding migrations:
+#
+#   python -m app.bulk_import todos.ndjson --owner-id 1
+#   python -m app.bulk_import todos.csv --format csv --chunk-size 10000
+
+import argparse
+import codecs
+import csv
+import io
+import json
+import sys
+import time
+from datetime import datetime
+from itertools import islice
+from typing import Callable, Iterable, Iterator
+
+from pydantic import ValidationError
+from sqlalchemy import Engine, insert
+from sqlalchemy.engine import Connection
+
+from config import Config
+
+from app import get_logger, schemas
+from app.models import Todo
+
+logger = get_logger(__name__)
+
+# max number of invalid rows reported in the import result
+MAX_ERRORS = 100
+
+COLUMNS = ("text", "completed", "owner_id", "created_at", "updated_at")
+
+
+# decode a stream of byte chunks into lines, chunks may split lines and
+# multi-byte characters
+def iter_lines(chunks: Iterable[bytes]) -> Iterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    for chunk in chunks:
+        # split on newlines only, str.splitlines also splits on characters
+        # allowed unescaped in json strings, like U+2028
+        *lines, pending = (pending + decoder.decode(chunk)).split("\n")
+        for line in lines:
+            yield line + "\n"
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+# (line number, record or None if the line is not valid ndjson)
+def parse_ndjson(lines: Iterable[str]) -> Iterator[tuple[int, dict | None]]:
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield line_number, record if isinstance(record, dict) else None
+
+
+# csv records may span lines, numbered by record instead, the header is 1
+def parse_csv(lines: Iterable[str]) -> Iterator[tuple[int, dict | None]]:
+    for line_number, record in enumerate(csv.DictReader(lines), start=2):
+        # empty completed / owner_id fields fall back to their defaults
+        yield line_number, {key: value for key, value in record.items() if value}
+
+
+PARSERS = {"ndjson": parse_ndjson, "csv": parse_csv}
+
+
+def copy_chunk(conn: Connection, rows: list[dict]) -> None:
+    buffer = io.StringIO()
+    # nonnumeric quoting writes None unquoted, which COPY reads as NULL, and
+    # empty strings quoted
+    writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC)
+    writer.writerows([row[column] for column in COLUMNS] for row in rows)
+    buffer.seek(0)
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY todos ({', '.join(COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buffer
+        )
+    finally:
+        cursor.close()
+
+
+def insert_chunk(engine: Engine, rows: list[dict]) -> None:
+    with engine.begin() as conn:
+        if conn.dialect.name == "postgresql" and conn.dialect.driver == "psycopg2":
+            copy_chunk(conn, rows)
+        else:
+            conn.execute(insert(Todo.__table__), rows)
+
+
+def error_message(error: Exception) -> str:
+    if isinstance(error, ValidationError):
+        return "; ".join(
+            f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in error.errors()
+        )
+    return str(error)
+
+
+# import the (line number, record) pairs of parse_ndjson / parse_csv.
+# `owner_id` is the owner of records without one, or of all records with
+# `force_owner`. `progress` is called with the number of imported rows and the
+# elapsed seconds after each chunk
+def import_todos(
+    engine: Engine,
+    records: Iterable[tuple[int, dict | None]],
+    owner_id: int | None = None,
+    force_owner: bool = False,
+    chunk_size: int = Config.IMPORT_CHUNK_SIZE,
+    progress: Callable[[int, float], None] | None = None,
+) -> schemas.TodoImportResult:
+    imported = failed = 0
+    errors = []
+    started = time.perf_counter()
+
+    def valid_rows() -> Iterator[dict]:
+        nonlocal failed
+        for line_number, record in records:
+            try:
+                if record is None:
+                    raise ValueError("invalid record")
+                todo = schemas.TodoCreate.model_validate(record)
+                owner = owner_id if force_owner else record.get("owner_id", owner_id)
+                if owner is None:
+                    raise ValueError("owner_id is required")
+                owner = int(owner)
+            except (ValidationError, ValueError, TypeError) as e:
+                failed += 1
+                if len(errors) < MAX_ERRORS:
+                    errors.append(f"line {line_number}: {error_message(e)}")
+                continue
+            yield {"text": todo.text, "completed": todo.completed, "owner_id": owner}
+
+    rows = valid_rows()
+    while chunk := list(islice(rows, chunk_size)):
+        now = datetime.utcnow()
+        for row in chunk:
+            row["created_at"] = row["updated_at"] = now
+        insert_chunk(engine, chunk)
+        imported += len(chunk)
+        if progress:
+            progress(imported, time.perf_counter() - started)
+
+    seconds = time.perf_counter() - started
+    return schemas.TodoImportResult(
+        imported=imported,
+        failed=failed,
+        errors=errors,
+        seconds=round(seconds, 3),
+        rows_per_second=round(imported / seconds) if seconds else 0,
+    )
+
+
+def log_progress(imported: int, seconds: float) -> None:
+    logger.info(f"imported {imported} todos ({imported / seconds:.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    from app.db import engine
+
+    parser = argparse.ArgumentParser(description="bulk import todos")
+    parser.add_argument("path", help="ndjson or csv file, - for stdin")
+    parser.add_argument("--format", choices=PARSERS, default=None)
+    parser.add_argument("--owner-id", type=int, help="owner of rows without one")
+    parser.add_argument("--chunk-size", type=int, default=Config.IMPORT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    format = args.format or ("csv" if args.path.endswith(".csv") else "ndjson")
+    if args.path == "-":
+        file = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8", newline="")
+    else:
+        file = open(args.path, encoding="utf-8", newline="")
+    with file:
+        result = import_todos(
+            engine,
+            PARSERS[format](file),
+            owner_id=args.owner_id,
+            chunk_size=args.chunk_size,
+            progress=log_progress,
+        )
+    print(result.model_dump_json(indent=2))
@@ -1,10 +1,16 @@
-from sqlalchemy.orm import Session
+from datetime import datetime
+
+from sqlalchemy import delete, func, insert, select, tuple_, update
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
 
 from config import Config
 
 from app import schemas
-from app.models import Todo, User
-from app.security import get_password_hash
+from app.models import Todo, TodoCount, TodoTombstone, TodoVersion, User
+from app.events import publish_todo
+from app.search import search_todos_select
+from app.stats import stats_cache
 
 PAGINATION_LIMIT = Config.PAGINATION_LIMIT
 
@@ -13,18 +19,51 @@ def get_user(db: Session, user_id: int):
     return db.query(User).filter(User.id == user_id).first()
 
 
+# for the UserReadNested response shape, the nested todos are bounded to the
+# first `todos_limit` todos (by created_at, id), loaded with one query instead
+# of lazy loading the whole collection
+def get_user_with_todos(db: Session, user_id: int, todos_limit: int = PAGINATION_LIMIT):
+    user = get_user(db, user_id)
+    if user is None:
+        return None
+    todos = get_user_todos_keyset(db, user_id, limit=todos_limit)
+    set_committed_value(user, "todos", todos)
+    return user
+
+
 def get_user_by_email(db: Session, email: str):
     return db.query(User).filter(User.email == email).first()
 
 
 def get_users(db: Session, offset: int = 0, limit: int = PAGINATION_LIMIT):
-    return db.query(User).offset(offset).limit(limit).all()
+    return (
+        db.query(User)
+        .order_by(User.created_at, User.id)
+        .offset(offset)
+        .limit(limit)
+        .all()
+    )
+
+
+# keyset pagination, `after` is the (created_at, id) of the previous page's last row
+def get_users_keyset(
+    db: Session,
+    after: tuple[datetime, int] | None = None,
+    limit: int = PAGINATION_LIMIT,
+):
+    query = db.query(User)
+    if after:
+        query = query.filter(tuple_(User.created_at, User.id) > after)
+    return query.order_by(User.created_at, User.id).limit(limit).all()
 
 
-def create_user(db: Session, user_data: schemas.UserCreate) -> User:
+# the password is hashed by the caller, awaiting the password hash pool
+def create_user(
+    db: Session, user_data: schemas.UserCreate, hashed_password: str
+) -> User:
     user = User(
         email=user_data.email,
-        hashed_password=get_password_hash(user_data.password),
+        hashed_password=hashed_password,
         full_name=user_data.full_name,
         is_superuser=user_data.is_superuser,
     )
@@ -37,15 +76,18 @@ def create_user(db: Session, user_data: schemas.UserCreate) -> User:
 # todo: split into separate crud python files for each model
 
 
-def create_todo(db: Session, owner_user: User, todo_data: schemas.TodoCreate):
+def create_todo(
+    db: Session, owner_user: User | schemas.UserPrincipal, todo_data: schemas.TodoCreate
+):
     todo = Todo(
         text=todo_data.text,
         completed=todo_data.completed,
-        owner=owner_user,
+        owner_id=owner_user.id,
     )
     db.add(todo)
     db.commit()
     db.refresh(todo)
+    publish_todo("created", todo.owner_id, todo.id, todo)
     return todo
 
 
@@ -55,6 +97,7 @@ def update_todo(db: Session, id: int, todo_data: schemas.TodoUpdate):
     todo.completed = todo_data.completed
     db.commit()
     db.refresh(todo)
+    publish_todo("updated", todo.owner_id, todo.id, todo)
     return todo
 
 
@@ -62,23 +105,318 @@ def delete_todo(db: Session, id: int):
     todo = db.query(Todo).filter(Todo.id == id).first()
     db.delete(todo)
     db.commit()
+    publish_todo("deleted", todo.owner_id, id)
+
+
+# batch operations apply all items in one transaction, with one executemany
+# statement per operation instead of a commit and refresh per item.
+# they return core rows instead of orm objects, which are not expired by the
+# commit, so reading them doesn't trigger a refresh query per item.
+
+
+def create_todos(
+    db: Session,
+    owner_user: User | schemas.UserPrincipal,
+    todos_data: list[schemas.TodoCreate],
+) -> list:
+    # an empty executemany would insert a single row of defaults
+    if not todos_data:
+        return []
+    todos = Todo.__table__
+    rows = db.execute(
+        insert(todos).returning(*todos.c),
+        [
+            {
+                "text": todo_data.text,
+                "completed": todo_data.completed,
+                "owner_id": owner_user.id,
+            }
+            for todo_data in todos_data
+        ],
+    ).all()
+    db.commit()
+    for row in rows:
+        publish_todo("created", row.owner_id, row.id, row)
+    # one multi-row insert assigns ascending ids in parameter order, sort by id
+    # instead of sort_by_parameter_order, which falls back to a statement per
+    # row on sqlite
+    return sorted(rows, key=lambda row: row.id)
+
+
+# only todos owned by `owner_user` are updated, returns a dict of updated rows
+# by id, ids missing from it are not found
+def update_todos(
+    db: Session,
+    owner_user: User | schemas.UserPrincipal,
+    todos_data: list[schemas.TodoUpdate],
+) -> dict:
+    todos = Todo.__table__
+    ids = [todo_data.id for todo_data in todos_data]
+    owned_ids = set(
+        db.scalars(
+            select(todos.c.id).where(
+                todos.c.id.in_(ids), todos.c.owner_id == owner_user.id
+            )
+        )
+    )
+    if owned_ids:
+        db.execute(
+            update(Todo),
+            [
+                {"id": t.id, "text": t.text, "completed": t.completed}
+                for t in todos_data
+                if t.id in owned_ids
+            ],
+        )
+    rows = db.execute(select(todos).where(todos.c.id.in_(owned_ids))).all()
+    db.commit()
+    for row in rows:
+        publish_todo("updated", row.owner_id, row.id, row)
+    return {row.id: row for row in rows}
+
+
+# only todos owned by `owner_user` are deleted, returns the set of deleted ids
+def delete_todos(
+    db: Session, owner_user: User | schemas.UserPrincipal, ids: list[int]
+) -> set[int]:
+    todos = Todo.__table__
+    deleted_ids = set(
+        db.scalars(
+            delete(todos)
+            .where(todos.c.id.in_(ids), todos.c.owner_id == owner_user.id)
+            .returning(todos.c.id)
+        )
+    )
+    db.commit()
+    for id in deleted_ids:
+        publish_todo("deleted", owner_user.id, id)
+    return deleted_ids
+
+
+# full-text search of the todos of an owner, ranked by search score, returns
+# (Todo, score) rows. `after` is the (score, id) of the previous page's last row
+def search_todos(
+    db: Session,
+    owner_id: int,
+    text: str,
+    after: tuple[float, int] | None = None,
+    limit: int = PAGINATION_LIMIT,
+) -> list:
+    stmt, score = search_todos_select(db.get_bind().dialect.name, text)
+    stmt = stmt.where(Todo.owner_id == owner_id)
+    if after:
+        stmt = stmt.where(tuple_(score, Todo.id) > after)
+    return db.execute(stmt.order_by(score, Todo.id).limit(limit)).all()
+
+
+# todo stats from the counts maintained by triggers, see app/stats.py
+def todo_stats(total: int, completed: int) -> dict:
+    return {"total": total, "completed": completed, "open": total - completed}
+
+
+def todo_stats_stmt():
+    return select(
+        func.coalesce(func.sum(TodoCount.total), 0),
+        func.coalesce(func.sum(TodoCount.completed), 0),
+    )
+
+
+# a primary key lookup
+def get_user_todo_stats(db: Session, owner_id: int) -> dict:
+    counts = db.get(TodoCount, owner_id)
+    if counts is None:
+        return todo_stats(0, 0)
+    return todo_stats(counts.total, counts.completed)
+
+
+def get_todo_stats(db: Session) -> dict:
+    stats = stats_cache.get("todos")
+    if stats is None:
+        stats = todo_stats(*db.execute(todo_stats_stmt()).one())
+        stats_cache.set("todos", stats)
+    return stats
+
+
+# changes of the todos of an owner since a version, see app/sync.py
+def todo_changes_stmts(owner_id: int, since: int, limit: int) -> tuple:
+    todos = (
+        select(Todo)
+        .where(Todo.owner_id == owner_id, Todo.version > since)
+        .order_by(Todo.version)
+        .limit(limit)
+    )
+    tombstones = (
+        select(TodoTombstone.todo_id, TodoTombstone.version)
+        .where(TodoTombstone.owner_id == owner_id, TodoTombstone.version > since)
+        .order_by(TodoTombstone.version)
+        .limit(limit)
+    )
+    return todos, tombstones
+
+
+# the first `limit` changes of both lists, in version order
+def merge_todo_changes(todos: list, tombstones: list, limit: int) -> list[dict]:
+    changes = [
+        {"id": todo.id, "version": todo.version, "deleted": False, "todo": todo}
+        for todo in todos
+    ]
+    changes += [
+        {"id": row.todo_id, "version": row.version, "deleted": True}
+        for row in tombstones
+    ]
+    changes.sort(key=lambda change: change["version"])
+    return changes[:limit]
 
 
+def get_sync_version(db: Session, owner_id: int) -> TodoVersion | None:
+    return db.get(TodoVersion, owner_id)
+
+
+def get_todo_changes(db: Session, owner_id: int, since: int, limit: int) -> list:
+    todos, tombstones = todo_changes_stmts(owner_id, since, limit)
+    return merge_todo_changes(
+        db.execute(todos).scalars().all(), db.execute(tombstones).all(), limit
+    )
+
+
+# for the TodoReadNested response shape, the owner is joined in the same query
 def get_todo(db: Session, id: int):
-    return db.query(Todo).get(id)
+    return db.get(Todo, id, options=[joinedload(Todo.owner)])
 
 
 def get_todos(db: Session, offset: int = 0, limit: int = PAGINATION_LIMIT):
-    return db.query(Todo).offset(offset).limit(limit).all()
+    return (
+        db.query(Todo)
+        .order_by(Todo.created_at, Todo.id)
+        .offset(offset)
+        .limit(limit)
+        .all()
+    )
 
 
+# optionally filter by completed status, served by the
+# (owner_id, completed, created_at, id) index
 def get_user_todos(
-    db: Session, user_id: int, offset: int = 0, limit: int = PAGINATION_LIMIT
+    db: Session,
+    user_id: int,
+    offset: int = 0,
+    limit: int = PAGINATION_LIMIT,
+    completed: bool | None = None,
+):
+    query = db.query(Todo).filter(Todo.owner_id == user_id)
+    if completed is not None:
+        query = query.filter(Todo.completed == completed)
+    return query.order_by(Todo.created_at, Todo.id).offset(offset).limit(limit).all()
+
+
+# keyset pagination, `after` is the (created_at, id) of the previous page's last row
+def get_todos_keyset(
+    db: Session,
+    after: tuple[datetime, int] | None = None,
+    limit: int = PAGINATION_LIMIT,
+):
+    query = db.query(Todo)
+    if after:
+        query = query.filter(tuple_(Todo.created_at, Todo.id) > after)
+    return query.order_by(Todo.created_at, Todo.id).limit(limit).all()
+
+
+def get_user_todos_keyset(
+    db: Session,
+    user_id: int,
+    after: tuple[datetime, int] | None = None,
+    limit: int = PAGINATION_LIMIT,
+    completed: bool | None = None,
+):
+    query = db.query(Todo).filter(Todo.owner_id == user_id)
+    if completed is not None:
+        query = query.filter(Todo.completed == completed)
+    if after:
+        query = query.filter(tuple_(Todo.created_at, Todo.id) > after)
+    return query.order_by(Todo.created_at, Todo.id).limit(limit).all()
+
+
+# select of the given columns of a todos list page, the same page as the list
+# queries above return.
+# the statements are shared with crud_async
+def todos_stmt(
+    *columns,
+    user_id: int | None = None,
+    completed: bool | None = None,
+    after: tuple[datetime, int] | None = None,
+    offset: int = 0,
+    limit: int = PAGINATION_LIMIT,
+):
+    stmt = select(*columns)
+    if user_id:
+        stmt = stmt.filter(Todo.owner_id == user_id)
+        if completed is not None:
+            stmt = stmt.filter(Todo.completed == completed)
+    if after:
+        stmt = stmt.filter(tuple_(Todo.created_at, Todo.id) > after)
+    return stmt.order_by(Todo.created_at, Todo.id).offset(offset).limit(limit)
+
+
+def users_stmt(
+    *columns,
+    after: tuple[datetime, int] | None = None,
+    offset: int = 0,
+    limit: int = PAGINATION_LIMIT,
 ):
+    stmt = select(*columns)
+    if after:
+        stmt = stmt.filter(tuple_(User.created_at, User.id) > after)
+    return stmt.order_by(User.created_at, User.id).offset(offset).limit(limit)
+
+
+# versions (id, updated_at) of the rows of a todos list page. used as a cheap
+# check whether a page changed without loading and serializing the full rows.
+def todos_versions_stmt(**kwargs):
+    return todos_stmt(Todo.id, Todo.updated_at, **kwargs)
+
+
+# version of a todo and its owner, for the TodoReadNested response shape
+def todo_version_stmt(id: int):
     return (
-        db.query(Todo)
+        select(Todo.updated_at, User.updated_at).join(Todo.owner).filter(Todo.id == id)
+    )
+
+
+def get_todos_versions(db: Session, **kwargs) -> list:
+    return db.execute(todos_versions_stmt(**kwargs)).all()
+
+
+def get_todo_version(db: Session, id: int):
+    return db.execute(todo_version_stmt(id)).first()
+
+
+# columns of the TodoRead and UserRead response schemas, in field order.
+# plain row tuples of these columns skip the orm identity map and can be
+# encoded to json as is (see app/fast_json.py)
+TODO_READ_COLUMNS = [getattr(Todo, name) for name in schemas.TodoRead.model_fields]
+USER_READ_COLUMNS = [getattr(User, name) for name in schemas.UserRead.model_fields]
+
+
+# todos list page as TodoRead rows, `after` selects keyset pagination
+def get_todos_rows(db: Session, **kwargs) -> list:
+    return db.execute(todos_stmt(*TODO_READ_COLUMNS, **kwargs)).all()
+
+
+# users list page as UserRead rows, with the sort key columns the cursor of the
+# next page is made of
+def get_users_rows(db: Session, **kwargs) -> list:
+    return db.execute(users_stmt(*USER_READ_COLUMNS, User.id, **kwargs)).all()
+
+
+# all todos of a user as TodoRead rows, in lists of up to `chunk_size` rows
+# fetched from a server-side cursor, for streaming exports
+def stream_user_todos(
+    db: Session, user_id: int, chunk_size: int = Config.EXPORT_CHUNK_SIZE
+):
+    stmt = (
+        select(*TODO_READ_COLUMNS)
         .filter(Todo.owner_id == user_id)
-        .offset(offset)
-        .limit(limit)
-        .all()
+        .order_by(Todo.created_at, Todo.id)
+        .execution_options(yield_per=chunk_size)
     )
+    yield from db.execute(stmt).partitions()
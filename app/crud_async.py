@@ -0,0 +1,246 @@
+# async versions of the crud.py functions, used with AsyncSession when
+# Config.SQLALCHEMY_ASYNC is enabled
+#
+# async sessions don't support implicit lazy loading, so relationships
+# needed by the nested response schemas are loaded eagerly
+
+from datetime import datetime
+
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+
+from config import Config
+
+from app import schemas
+from app.crud import (
+    TODO_READ_COLUMNS,
+    USER_READ_COLUMNS,
+    merge_todo_changes,
+    todo_changes_stmts,
+    todo_stats,
+    todo_stats_stmt,
+    todo_version_stmt,
+    todos_stmt,
+    todos_versions_stmt,
+    users_stmt,
+)
+from app.models import Todo, TodoCount, TodoVersion, User
+from app.events import publish_todo
+from app.search import search_todos_select
+from app.security import get_password_hash_async
+from app.stats import stats_cache
+
+PAGINATION_LIMIT = Config.PAGINATION_LIMIT
+
+
+async def get_user(db: AsyncSession, user_id: int):
+    stmt = select(User).filter(User.id == user_id)
+    return (await db.execute(stmt)).scalars().first()
+
+
+async def get_user_with_todos(
+    db: AsyncSession, user_id: int, todos_limit: int = PAGINATION_LIMIT
+):
+    user = await get_user(db, user_id)
+    if user is None:
+        return None
+    todos = await get_user_todos_keyset(db, user_id, limit=todos_limit)
+    set_committed_value(user, "todos", todos)
+    return user
+
+
+async def get_user_by_email(db: AsyncSession, email: str):
+    stmt = select(User).filter(User.email == email)
+    return (await db.execute(stmt)).scalars().first()
+
+
+async def get_users(db: AsyncSession, offset: int = 0, limit: int = PAGINATION_LIMIT):
+    stmt = select(User).order_by(User.created_at, User.id).offset(offset).limit(limit)
+    return (await db.execute(stmt)).scalars().all()
+
+
+async def get_users_keyset(
+    db: AsyncSession,
+    after: tuple[datetime, int] | None = None,
+    limit: int = PAGINATION_LIMIT,
+):
+    stmt = select(User)
+    if after:
+        stmt = stmt.filter(tuple_(User.created_at, User.id) > after)
+    stmt = stmt.order_by(User.created_at, User.id).limit(limit)
+    return (await db.execute(stmt)).scalars().all()
+
+
+async def create_user(db: AsyncSession, user_data: schemas.UserCreate) -> User:
+    user = User(
+        email=user_data.email,
+        hashed_password=await get_password_hash_async(user_data.password),
+        full_name=user_data.full_name,
+        is_superuser=user_data.is_superuser,
+    )
+    db.add(user)
+    await db.commit()
+    await db.refresh(user)
+    return user
+
+
+async def create_todo(
+    db: AsyncSession,
+    owner_user: User | schemas.UserPrincipal,
+    todo_data: schemas.TodoCreate,
+):
+    todo = Todo(
+        text=todo_data.text,
+        completed=todo_data.completed,
+        owner_id=owner_user.id,
+    )
+    db.add(todo)
+    await db.commit()
+    await db.refresh(todo)
+    publish_todo("created", todo.owner_id, todo.id, todo)
+    return todo
+
+
+async def update_todo(db: AsyncSession, id: int, todo_data: schemas.TodoUpdate):
+    todo = await db.get(Todo, id)
+    todo.text = todo_data.text
+    todo.completed = todo_data.completed
+    await db.commit()
+    await db.refresh(todo)
+    publish_todo("updated", todo.owner_id, todo.id, todo)
+    return todo
+
+
+async def delete_todo(db: AsyncSession, id: int):
+    todo = await db.get(Todo, id)
+    await db.delete(todo)
+    await db.commit()
+    publish_todo("deleted", todo.owner_id, id)
+
+
+async def search_todos(
+    db: AsyncSession,
+    owner_id: int,
+    text: str,
+    after: tuple[float, int] | None = None,
+    limit: int = PAGINATION_LIMIT,
+) -> list:
+    stmt, score = search_todos_select(db.get_bind().dialect.name, text)
+    stmt = stmt.where(Todo.owner_id == owner_id)
+    if after:
+        stmt = stmt.where(tuple_(score, Todo.id) > after)
+    return (await db.execute(stmt.order_by(score, Todo.id).limit(limit))).all()
+
+
+async def get_user_todo_stats(db: AsyncSession, owner_id: int) -> dict:
+    counts = await db.get(TodoCount, owner_id)
+    if counts is None:
+        return todo_stats(0, 0)
+    return todo_stats(counts.total, counts.completed)
+
+
+async def get_todo_stats(db: AsyncSession) -> dict:
+    stats = stats_cache.get("todos")
+    if stats is None:
+        stats = todo_stats(*(await db.execute(todo_stats_stmt())).one())
+        stats_cache.set("todos", stats)
+    return stats
+
+
+async def get_sync_version(db: AsyncSession, owner_id: int) -> TodoVersion | None:
+    return await db.get(TodoVersion, owner_id)
+
+
+async def get_todo_changes(
+    db: AsyncSession, owner_id: int, since: int, limit: int
+) -> list:
+    todos, tombstones = todo_changes_stmts(owner_id, since, limit)
+    return merge_todo_changes(
+        (await db.execute(todos)).scalars().all(),
+        (await db.execute(tombstones)).all(),
+        limit,
+    )
+
+
+async def get_todo(db: AsyncSession, id: int):
+    return await db.get(Todo, id, options=[joinedload(Todo.owner)])
+
+
+async def get_todos(db: AsyncSession, offset: int = 0, limit: int = PAGINATION_LIMIT):
+    stmt = select(Todo).order_by(Todo.created_at, Todo.id).offset(offset).limit(limit)
+    return (await db.execute(stmt)).scalars().all()
+
+
+async def get_user_todos(
+    db: AsyncSession,
+    user_id: int,
+    offset: int = 0,
+    limit: int = PAGINATION_LIMIT,
+    completed: bool | None = None,
+):
+    stmt = select(Todo).filter(Todo.owner_id == user_id)
+    if completed is not None:
+        stmt = stmt.filter(Todo.completed == completed)
+    stmt = stmt.order_by(Todo.created_at, Todo.id).offset(offset).limit(limit)
+    return (await db.execute(stmt)).scalars().all()
+
+
+async def get_todos_keyset(
+    db: AsyncSession,
+    after: tuple[datetime, int] | None = None,
+    limit: int = PAGINATION_LIMIT,
+):
+    stmt = select(Todo)
+    if after:
+        stmt = stmt.filter(tuple_(Todo.created_at, Todo.id) > after)
+    stmt = stmt.order_by(Todo.created_at, Todo.id).limit(limit)
+    return (await db.execute(stmt)).scalars().all()
+
+
+async def get_user_todos_keyset(
+    db: AsyncSession,
+    user_id: int,
+    after: tuple[datetime, int] | None = None,
+    limit: int = PAGINATION_LIMIT,
+    completed: bool | None = None,
+):
+    stmt = select(Todo).filter(Todo.owner_id == user_id)
+    if completed is not None:
+        stmt = stmt.filter(Todo.completed == completed)
+    if after:
+        stmt = stmt.filter(tuple_(Todo.created_at, Todo.id) > after)
+    stmt = stmt.order_by(Todo.created_at, Todo.id).limit(limit)
+    return (await db.execute(stmt)).scalars().all()
+
+
+async def get_todos_versions(db: AsyncSession, **kwargs) -> list:
+    return (await db.execute(todos_versions_stmt(**kwargs))).all()
+
+
+async def get_todo_version(db: AsyncSession, id: int):
+    return (await db.execute(todo_version_stmt(id))).first()
+
+
+async def get_todos_rows(db: AsyncSession, **kwargs) -> list:
+    return (await db.execute(todos_stmt(*TODO_READ_COLUMNS, **kwargs))).all()
+
+
+async def get_users_rows(db: AsyncSession, **kwargs) -> list:
+    stmt = users_stmt(*USER_READ_COLUMNS, User.id, **kwargs)
+    return (await db.execute(stmt)).all()
+
+
+async def stream_user_todos(
+    db: AsyncSession, user_id: int, chunk_size: int = Config.EXPORT_CHUNK_SIZE
+):
+    stmt = (
+        select(*TODO_READ_COLUMNS)
+        .filter(Todo.owner_id == user_id)
+        .order_by(Todo.created_at, Todo.id)
+        .execution_options(yield_per=chunk_size)
+    )
+    result = await db.stream(stmt)
+    async for rows in result.partitions():
+        yield rows
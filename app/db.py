@@ -1,8 +1,18 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from fastapi import Request, Response
 from sqlalchemy.orm import sessionmaker
 
 from config import Config
 
+from app.db_pool import InstrumentedAsyncQueuePool, InstrumentedQueuePool
+from app.replicas import (
+    STICKY_COOKIE,
+    AsyncRoutingSession,
+    ReplicaSet,
+    RoutingSession,
+)
+
 SQLALCHEMY_DATABASE_URI = Config.SQLALCHEMY_DATABASE_URI
 
 # set check_same_thread to false specifically for sqlite3 file database
@@ -14,16 +24,82 @@ if SQLALCHEMY_DATABASE_URI.startswith("sqlite:"):
 else:
     connect_args = {}
 
+
+# sqlite tuning for multi-worker deployments, set on every new connection
+# - WAL journal: readers don't block the writer, and the writer doesn't block
+#   readers, of all the worker processes, instead of the rollback journal
+# - synchronous=NORMAL: no fsync per commit in WAL mode, only at checkpoints,
+#   a power loss may lose the last commits but doesn't corrupt the db
+# - mmap_size, cache_size: read pages from a memory map and a bigger page cache
+# - busy_timeout: wait for the write lock of another connection, instead of
+#   failing with "database is locked"
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA mmap_size={Config.SQLITE_MMAP_SIZE}")
+    # negative sizes are in KiB instead of pages
+    cursor.execute(f"PRAGMA cache_size=-{Config.SQLITE_CACHE_SIZE_KIB}")
+    cursor.execute(f"PRAGMA busy_timeout={Config.SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
+
+SQLITE_TUNED = SQLALCHEMY_DATABASE_URI.startswith("sqlite:") and Config.SQLITE_WAL
+
+# connection pool settings shared by sync and async engines
+pool_args = {
+    "pool_size": Config.DB_POOL_SIZE,
+    "max_overflow": Config.DB_MAX_OVERFLOW,
+    "pool_timeout": Config.DB_POOL_TIMEOUT,
+    "pool_recycle": Config.DB_POOL_RECYCLE,
+    "pool_pre_ping": Config.DB_POOL_PRE_PING,
+}
+
 engine = create_engine(
     SQLALCHEMY_DATABASE_URI,
     connect_args=connect_args,
-    # enable sql statements logging for debug/development
-    echo=True,
+    # queue pool instrumented with checkout wait time and overflow metrics
+    poolclass=InstrumentedQueuePool,
+    **pool_args,
+    # log every sql statement, for local development only, see
+    # app/sql_profiling.py for per-request profiling and the slow query log
+    echo=Config.SQLALCHEMY_ECHO,
 )
+if SQLITE_TUNED:
+    event.listen(engine, "connect", set_sqlite_pragmas)
 
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+
+# read replicas of the primary, used by the GET requests, see app/replicas.py
+def create_replica_engine(uri: str):
+    replica_engine = create_engine(
+        uri,
+        connect_args=connect_args,
+        poolclass=InstrumentedQueuePool,
+        **pool_args,
+        echo=Config.SQLALCHEMY_ECHO,
+    )
+    if SQLITE_TUNED:
+        event.listen(replica_engine, "connect", set_sqlite_pragmas)
+    return replica_engine
+
+
+replica_engines = [create_replica_engine(uri) for uri in Config.SQLALCHEMY_REPLICA_URIS]
+if replica_engines:
+    replicas = ReplicaSet(replica_engines, Config.REPLICA_CHECK_INTERVAL)
+    RoutingSessionLocal = sessionmaker(
+        class_=RoutingSession,
+        autocommit=False,
+        autoflush=False,
+        bind=engine,
+        replicas=replicas,
+    )
+else:
+    replicas = None
+    RoutingSessionLocal = None
+
 # create the FastAPI's dependency function for db session
 
 # def get_db():
@@ -35,7 +111,95 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 #         db.close()
 
 
+# GET requests read from a replica unless the client wrote recently, other
+# requests mark the client to read from the primary
+def route_reads(db: RoutingSession, request: Request, response: Response) -> None:
+    if request.method in ("GET", "HEAD"):
+        db.use_replica = STICKY_COOKIE not in request.cookies
+    else:
+        response.set_cookie(
+            STICKY_COOKIE,
+            "1",
+            max_age=Config.REPLICA_STICKY_SECONDS,
+            httponly=True,
+            samesite="lax",
+        )
+
+
 # prefer context-manager (with .. as ..) syntax, which auto-closes session
-def get_db():
-    with SessionLocal() as db:
+def get_db(request: Request, response: Response):
+    if replicas is None:
+        with SessionLocal() as db:
+            yield db
+        return
+
+    with RoutingSessionLocal() as db:
+        route_reads(db, request, response)
+        yield db
+
+
+# async engine and session for running api routes natively on the event loop
+# only created when async mode is enabled, so that the async drivers
+# (aiosqlite, asyncpg) are not required for the default sync mode
+# the sync engine above is still used by db migrations and web routes
+SQLALCHEMY_ASYNC_DATABASE_URI = Config.SQLALCHEMY_ASYNC_DATABASE_URI
+
+if Config.SQLALCHEMY_ASYNC:
+    async_engine = create_async_engine(
+        SQLALCHEMY_ASYNC_DATABASE_URI,
+        poolclass=InstrumentedAsyncQueuePool,
+        **pool_args,
+        echo=Config.SQLALCHEMY_ECHO,
+    )
+    if SQLITE_TUNED:
+        event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+    # expire_on_commit must be off for async sessions, otherwise accessing
+    # attributes after commit triggers implicit (unsupported) lazy io
+    AsyncSessionLocal = async_sessionmaker(
+        bind=async_engine, autoflush=False, expire_on_commit=False
+    )
+else:
+    async_engine = None
+    AsyncSessionLocal = None
+
+# async engines of the read replicas, in the order of replica_engines
+if async_engine is not None and replicas is not None:
+    async_replica_engines = [
+        create_async_engine(
+            uri,
+            poolclass=InstrumentedAsyncQueuePool,
+            **pool_args,
+            echo=Config.SQLALCHEMY_ECHO,
+        )
+        for uri in Config.SQLALCHEMY_ASYNC_REPLICA_URIS
+    ]
+    for replica_engine, async_replica_engine in zip(
+        replica_engines, async_replica_engines
+    ):
+        if SQLITE_TUNED:
+            event.listen(
+                async_replica_engine.sync_engine, "connect", set_sqlite_pragmas
+            )
+        replicas.add_async_engine(replica_engine, async_replica_engine)
+    AsyncRoutingSessionLocal = async_sessionmaker(
+        bind=async_engine,
+        autoflush=False,
+        expire_on_commit=False,
+        sync_session_class=AsyncRoutingSession,
+        replicas=replicas,
+    )
+else:
+    async_replica_engines = []
+    AsyncRoutingSessionLocal = None
+
+
+# async equivalent of get_db, for async path operation functions
+async def get_async_db(request: Request, response: Response):
+    if AsyncRoutingSessionLocal is None:
+        async with AsyncSessionLocal() as db:
+            yield db
+        return
+
+    async with AsyncRoutingSessionLocal() as db:
+        route_reads(db.sync_session, request, response)
         yield db
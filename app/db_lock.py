@@ -0,0 +1,158 @@
+# database-backed lock of the schema migrations, shared by all the worker
+# processes of all the nodes (pods) using the database, unlike a file lock
+# which only works within one machine.
+#
+# - postgresql: a session level advisory lock (pg_try_advisory_lock) held by
+#   a dedicated connection, released with it if the process dies
+# - other databases (sqlite): a row in the migration_locks table, refreshed by
+#   a heartbeat thread while held, and taken over once stale, eg. when the
+#   process holding it was killed
+#
+# the migration_locks table is not part of the sqlalchemy models, so the
+# drop_all / create_all of the migration it guards don't touch it.
+#
+# a process that finds the lock taken polls until it gets it, or gives up
+# with TimeoutError after `timeout` seconds, instead of going on without the
+# tables.
+
+import hashlib
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from sqlalchemy import Engine, text
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from app import get_logger
+
+logger = get_logger(__name__)
+
+POLL_INTERVAL = 1.0
+# a lock row not refreshed for this many seconds is taken over
+STALE_SECONDS = 60
+HEARTBEAT_SECONDS = 10
+
+
+# 64-bit signed key of the advisory lock
+def advisory_lock_key(name: str) -> int:
+    return int.from_bytes(
+        hashlib.sha256(name.encode()).digest()[:8], "big", signed=True
+    )
+
+
+@contextmanager
+def advisory_lock(engine: Engine, name: str, timeout: float) -> Iterator[bool]:
+    key = advisory_lock_key(name)
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        waited = False
+        deadline = time.monotonic() + timeout
+        while not conn.scalar(text("SELECT pg_try_advisory_lock(:key)"), {"key": key}):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"failed to acquire lock {name} in {timeout}s")
+            if not waited:
+                logger.info(f"waiting for lock {name}")
+            waited = True
+            time.sleep(POLL_INTERVAL)
+        try:
+            yield waited
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": key})
+
+
+def create_lock_table(engine: Engine) -> None:
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "CREATE TABLE IF NOT EXISTS migration_locks ("
+                "name VARCHAR(255) PRIMARY KEY, "
+                "owner VARCHAR(255) NOT NULL, "
+                "heartbeat_at FLOAT NOT NULL)"
+            )
+        )
+
+
+def try_acquire_row_lock(engine: Engine, name: str, owner: str) -> bool:
+    now = time.time()
+    try:
+        with engine.begin() as conn:
+            conn.execute(
+                text(
+                    "DELETE FROM migration_locks "
+                    "WHERE name = :name AND heartbeat_at < :stale"
+                ),
+                {"name": name, "stale": now - STALE_SECONDS},
+            )
+            conn.execute(
+                text(
+                    "INSERT INTO migration_locks (name, owner, heartbeat_at) "
+                    "VALUES (:name, :owner, :now)"
+                ),
+                {"name": name, "owner": owner, "now": now},
+            )
+        return True
+    # held by another process, or the database is locked by its migration
+    except (IntegrityError, OperationalError):
+        return False
+
+
+@contextmanager
+def row_lock(engine: Engine, name: str, timeout: float) -> Iterator[bool]:
+    create_lock_table(engine)
+    owner = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+    waited = False
+    deadline = time.monotonic() + timeout
+    while not try_acquire_row_lock(engine, name, owner):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"failed to acquire lock {name} in {timeout}s")
+        if not waited:
+            logger.info(f"waiting for lock {name}")
+        waited = True
+        time.sleep(POLL_INTERVAL)
+
+    stopped = threading.Event()
+
+    def heartbeat():
+        while not stopped.wait(HEARTBEAT_SECONDS):
+            try:
+                with engine.begin() as conn:
+                    conn.execute(
+                        text(
+                            "UPDATE migration_locks SET heartbeat_at = :now "
+                            "WHERE name = :name AND owner = :owner"
+                        ),
+                        {"name": name, "owner": owner, "now": time.time()},
+                    )
+            # the database is busy with the migration, retry on the next beat
+            except OperationalError:
+                pass
+
+    thread = threading.Thread(target=heartbeat, name=f"lock-{name}", daemon=True)
+    thread.start()
+    try:
+        yield waited
+    finally:
+        stopped.set()
+        thread.join()
+        with engine.begin() as conn:
+            conn.execute(
+                text(
+                    "DELETE FROM migration_locks WHERE name = :name AND owner = :owner"
+                ),
+                {"name": name, "owner": owner},
+            )
+
+
+# hold the named lock for the duration of the with block, yields whether
+# another process held it first
+@contextmanager
+def migration_lock(engine: Engine, name: str, timeout: float) -> Iterator[bool]:
+    lock = advisory_lock if engine.dialect.name == "postgresql" else row_lock
+    with lock(engine, name, timeout) as waited:
+        logger.debug(f"locked {name}")
+        try:
+            yield waited
+        finally:
+            logger.debug(f"released {name}")
@@ -1,49 +1,53 @@
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
 from functools import wraps
-from filelock import FileLock, Timeout
+from itertools import accumulate
+from sqlalchemy import Engine, func, insert, inspect, select, text
+from config import Config
 from app import get_logger
+from app.bulk_import import insert_chunk
 from app.db import SessionLocal, engine
+from app.db_lock import migration_lock
 from app.models import Base, Todo, User
+from app.search import create_search_index
+from app.stats import (
+    create_stats_triggers,
+    reconcile_todo_counts,
+    stats_triggers_exist,
+)
+from app.sync import add_version_column, create_sync_triggers
 
 # logging.basicConfig(level=Config.LOG_LEVEL)
 # logger = logging.getLogger(__name__)
 logger = get_logger(__name__)
 
 
-# decorator to lock a function with a file lock:
-# - ensure only one process can run it at a time
-# - quit locking trial once timeout is reached
-# This is ONLY useful for multiple worker processes deployment with one
-# virtual machine, if there are distributed multiple virtual machines,
-# the file lock will not work as it only prevents multiple processes by
-# a file in the same virtual machine.
-def with_lock(lockfile, timeout=0):
+# decorator to run a migration function under a database lock, see
+# app/db_lock.py:
+# - ensure only one process of all the nodes sharing the db runs it at a time
+# - the other processes wait until it's done, instead of serving requests
+#   before the tables exist, then skip it, or run it again with `rerun`, for
+#   idempotent migrations, which also completes a migration whose process died
+# - raise TimeoutError after Config.MIGRATION_LOCK_TIMEOUT seconds, which
+#   fails the app startup
+def with_lock(name, rerun=False):
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            lock = FileLock(lockfile)
-            try:
-                lock.acquire(timeout=timeout)
-                logger.debug(f"locked {lockfile}")
+            with migration_lock(engine, name, Config.MIGRATION_LOCK_TIMEOUT) as waited:
+                if waited and not rerun:
+                    logger.info(f"{func.__name__} done by another process")
+                    return
                 return func(*args, **kwargs)
-            except Timeout:
-                logger.error(f"failed to acquire lock {lockfile}")
-                return
-            finally:
-                lock.release()
-                logger.debug(f"released {lockfile}")
 
         return wrapper
 
     return decorator
 
 
-# todo: need a distributed lock solution for multiple virtual machines deployment
-#   such as redis lock, database lock, etc.
-#   Note that for database lock the underlying table should NOT be part of
-#   salalchemy models, otherwise it will cause deadlock in shema migrations.
-
-
-@with_lock("reset_table.lock")
+@with_lock("reset_tables")
 def reset_tables():
     logger.info(">> sqlalchemy dropping existing tables")
     Base.metadata.drop_all(engine)
@@ -51,12 +55,54 @@ def reset_tables():
     Base.metadata.create_all(engine)
     logger.info(">> sqlalchemy loading initial data")
     init_data()
+    if Config.SEED_USERS:
+        seed_data(engine, Config.SEED_USERS, Config.SEED_TODOS, Config.SEED_SKEW)
+
 
+# indexes removed from the models, create_all doesn't drop them from
+# existing tables, so they are dropped explicitly on update
+OBSOLETE_INDEXES = {
+    "todos": ["ix_todos_text"],
+}
 
-@with_lock("update_table.lock")
+
+@with_lock("update_tables", rerun=True)
 def update_tables():
     logger.info(">> sqlalchemy creating or updating tables")
+    # the counts of the existing todos are backfilled once, by the update
+    # creating the count triggers, checked before create_all which creates
+    # them. later updates, and the workers re-running it, leave the drift to
+    # `python -m app.stats`
+    with engine.connect() as conn:
+        backfill_counts = not stats_triggers_exist(conn)
     Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        add_version_column(conn)
+    update_indexes()
+    # the search index, count and version triggers of an existing todos table,
+    # new tables get them on create
+    with engine.begin() as conn:
+        create_search_index(conn)
+        if create_stats_triggers(conn) and backfill_counts:
+            reconcile_todo_counts(conn)
+        create_sync_triggers(conn)
+
+
+# create_all only creates missing tables, create indexes added to the models
+# of existing tables, and drop indexes removed from the models
+def update_indexes():
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table_name, index_names in OBSOLETE_INDEXES.items():
+            existing = {index["name"] for index in inspector.get_indexes(table_name)}
+            for index_name in index_names:
+                if index_name in existing:
+                    logger.info(f">> sqlalchemy dropping obsolete index {index_name}")
+                    conn.execute(text(f"DROP INDEX {index_name}"))
 
 
 def init_data():
@@ -144,3 +190,158 @@ def init_data():
         ]
     )
     db.commit()
+
+
+# synthetic data, to reproduce the scaling issues of big tables: deep
+# pagination, users with many todos, search.
+# - users are inserted in chunks with core inserts, todos with the bulk import
+#   insert (COPY on postgresql), without the orm unit of work
+# - all users share one precomputed bcrypt hash, of the password "secret"
+# - todos per user follow a zipf-like distribution, the user of rank r gets
+#   todos in proportion to 1 / r ** skew, 0 spreads them evenly, 1 gives the
+#   top 1% of 100k users about 60% of the todos
+SEED_PASSWORD_HASH = "$2b$12$mV7rTpEAAk77POssNFkBfO.F0UvhU5Z2llYTbu3RcS8s8C3S2hNUC"
+SEED_CHUNK_SIZE = 10_000
+# created_at of the seeded rows are spread over this many past days
+SEED_DAYS = 365
+
+FIRST_NAMES = (
+    "James Mary John Patricia Robert Jennifer Michael Linda David Elizabeth "
+    "William Barbara Richard Susan Joseph Jessica Thomas Sarah Wei Aiko Omar "
+    "Fatima Lucas Sofia Mateo Chloe Arjun Priya Noah Emma Liam Olivia"
+).split()
+LAST_NAMES = (
+    "Smith Johnson Williams Brown Jones Garcia Miller Davis Rodriguez Martinez "
+    "Hernandez Lopez Gonzalez Wilson Anderson Thomas Taylor Moore Jackson Martin "
+    "Lee Chen Wang Kim Nguyen Patel Khan Silva Rossi Muller Dubois Tanaka"
+).split()
+TODO_VERBS = (
+    "Buy Call Email Fix Write Read Plan Review Clean Book Pay Schedule Update "
+    "Prepare Finish Start Organize Cancel Renew Order Return Learn Practice Visit"
+).split()
+TODO_OBJECTS = (
+    "groceries, the dentist, quarterly report, kitchen sink, blog post, "
+    "a book about databases, team offsite, pull request, garage, flight tickets, "
+    "electricity bill, car service, project roadmap, slides for the meetup, "
+    "passport, gym membership, birthday gift, library books, spanish lessons, "
+    "guitar scales, grandparents, tax return, insurance claim, backup drive"
+).split(", ")
+TODO_DETAILS = (
+    "",
+    "",
+    " before friday",
+    " this weekend",
+    " tomorrow morning",
+    " with Alice",
+    " after work",
+    " asap",
+    " for the new office",
+    " on the way home",
+)
+
+
+def seed_users(
+    engine: Engine, users: int, rng: random.Random, chunk_size: int
+) -> list[int]:
+    with engine.begin() as conn:
+        first_id = (conn.scalar(select(func.max(User.id))) or 0) + 1
+    now = datetime.utcnow()
+    for start in range(0, users, chunk_size):
+        rows = []
+        for n in range(start, min(start + chunk_size, users)):
+            created_at = now - timedelta(seconds=rng.randrange(SEED_DAYS * 86400))
+            rows.append(
+                {
+                    "email": f"user{n}@example.com",
+                    "hashed_password": SEED_PASSWORD_HASH,
+                    "fname": rng.choice(FIRST_NAMES),
+                    "lname": rng.choice(LAST_NAMES),
+                    "created_at": created_at,
+                    "updated_at": created_at,
+                }
+            )
+        with engine.begin() as conn:
+            conn.execute(insert(User.__table__), rows)
+        logger.info(f">> seeded {start + len(rows)} users")
+    with engine.begin() as conn:
+        return list(conn.scalars(select(User.id).where(User.id >= first_id)))
+
+
+def seed_todos(
+    engine: Engine,
+    user_ids: list[int],
+    todos: int,
+    skew: float,
+    rng: random.Random,
+    chunk_size: int,
+) -> None:
+    # heavy users at random ids, not all at the start of the table
+    owners = user_ids[:]
+    rng.shuffle(owners)
+    cum_weights = list(accumulate(1 / rank**skew for rank in range(1, len(owners) + 1)))
+    now = datetime.utcnow()
+    seeded = 0
+    while seeded < todos:
+        count = min(chunk_size, todos - seeded)
+        rows = []
+        for owner_id in rng.choices(owners, cum_weights=cum_weights, k=count):
+            created_at = now - timedelta(seconds=rng.randrange(SEED_DAYS * 86400))
+            completed = rng.random() < 0.4
+            rows.append(
+                {
+                    "text": f"{rng.choice(TODO_VERBS)} {rng.choice(TODO_OBJECTS)}"
+                    f"{rng.choice(TODO_DETAILS)}",
+                    "completed": completed,
+                    "owner_id": owner_id,
+                    "created_at": created_at,
+                    "updated_at": created_at
+                    + timedelta(seconds=rng.randrange(86400) if completed else 0),
+                }
+            )
+        insert_chunk(engine, rows)
+        seeded += count
+        logger.info(f">> seeded {seeded} todos")
+
+
+# seed `users` synthetic users, user0@example.com ... with password "secret",
+# and `todos` todos spread over them with the given skew
+def seed_data(
+    engine: Engine,
+    users: int,
+    todos: int,
+    skew: float = 1.0,
+    seed: int | None = None,
+    chunk_size: int = SEED_CHUNK_SIZE,
+) -> None:
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    user_ids = seed_users(engine, users, rng, chunk_size)
+    if user_ids and todos:
+        seed_todos(engine, user_ids, todos, skew, rng, chunk_size)
+    logger.info(
+        f">> seeded {users} users and {todos} todos "
+        f"in {time.perf_counter() - started:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="reset the db and seed it with synthetic users and todos"
+    )
+    parser.add_argument("--users", type=int, default=Config.SEED_USERS or 1000)
+    parser.add_argument("--todos", type=int, default=Config.SEED_TODOS)
+    parser.add_argument("--skew", type=float, default=Config.SEED_SKEW)
+    parser.add_argument("--seed", type=int, help="random seed, for repeatable data")
+    parser.add_argument("--chunk-size", type=int, default=SEED_CHUNK_SIZE)
+    parser.add_argument(
+        "--append", action="store_true", help="keep the existing tables and data"
+    )
+    args = parser.parse_args()
+
+    if args.append:
+        Base.metadata.create_all(engine)
+    else:
+        Base.metadata.drop_all(engine)
+        Base.metadata.create_all(engine)
+        init_data()
+    seed_data(engine, args.users, args.todos, args.skew, args.seed, args.chunk_size)
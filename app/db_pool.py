@@ -0,0 +1,97 @@
+# instrumented connection pools for the sqlalchemy engines
+#
+# the pools record how long callers wait to check out a connection,
+# how often checkouts go beyond pool_size into overflow connections,
+# and how often checkouts time out, so pool size can be tuned from data
+
+import threading
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+# upper bounds (seconds) of the checkout wait time histogram buckets
+WAIT_TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class PoolMetrics:
+    def __init__(self, buckets=WAIT_TIME_BUCKETS):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.wait_time_sum = 0.0
+        self.checkouts = 0
+        self.overflow_checkouts = 0
+        self.timeouts = 0
+
+    def observe_checkout(self, wait_time: float, overflow: bool):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_time_sum += wait_time
+            if overflow:
+                self.overflow_checkouts += 1
+            for i, upper_bound in enumerate(self.buckets):
+                if wait_time <= upper_bound:
+                    self.bucket_counts[i] += 1
+                    break
+
+    def observe_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def snapshot(self, pool) -> dict:
+        with self._lock:
+            # histogram buckets are cumulative, prometheus style
+            cumulative, buckets = 0, {}
+            for upper_bound, count in zip(self.buckets, self.bucket_counts):
+                cumulative += count
+                buckets[str(upper_bound)] = cumulative
+            buckets["+Inf"] = self.checkouts
+            return {
+                "pool_size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "checked_in": pool.checkedin(),
+                "overflow": pool.overflow(),
+                "checkouts": self.checkouts,
+                "overflow_checkouts": self.overflow_checkouts,
+                "timeouts": self.timeouts,
+                "wait_time_seconds": {
+                    "buckets": buckets,
+                    "sum": self.wait_time_sum,
+                    "count": self.checkouts,
+                },
+            }
+
+
+class InstrumentedPoolMixin:
+    # per pool, so each engine (primary, replicas, async) reports separately
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    # engine.dispose() replaces the pool with a recreated one, which keeps
+    # counting in the same metrics
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            conn = super().connect()
+        except exc.TimeoutError:
+            self.metrics.observe_timeout()
+            raise
+        self.metrics.observe_checkout(
+            time.perf_counter() - start, overflow=self.checkedout() > self.size()
+        )
+        return conn
+
+
+class InstrumentedQueuePool(InstrumentedPoolMixin, QueuePool):
+    pass
+
+
+class InstrumentedAsyncQueuePool(InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+    pass
@@ -0,0 +1,202 @@
+# in-process pub/sub of todo changes, pushed to the WebSocket and SSE
+# subscriptions of their owner, see app/routers/events.py
+#
+# crud functions publish an event after each committed todo write, from the
+# thread pool, the write queue thread or the event loop, the bus delivers it
+# on the event loop to the subscriptions of the todo owner in this worker.
+# events of the write queue are published after its group commit.
+#
+# each subscription has a queue of Config.EVENTS_QUEUE_SIZE events, a client
+# that doesn't keep up, and fills its queue, is dropped: it gets the queued
+# events then its subscription is closed, and it catches up with
+# GET /todos/changes before subscribing again. a slow client never blocks
+# the writes nor the other subscriptions.
+#
+# with multiple worker processes, a client only gets the events of the writes
+# served by its worker, unless Config.EVENTS_PG_NOTIFY is enabled on
+# postgresql: events are then sent with NOTIFY on the todo_events channel,
+# and every worker LISTENs and delivers them to its subscriptions. NOTIFY
+# payloads are limited to 8000 bytes, larger events are sent without the todo.
+
+import asyncio
+import contextlib
+import json
+import queue
+import select
+import threading
+import time
+from collections import defaultdict
+
+from sqlalchemy import Engine
+
+from config import Config
+
+from app import get_logger, metrics, schemas
+
+logger = get_logger(__name__)
+
+PG_CHANNEL = "todo_events"
+PG_MAX_PAYLOAD = 7999
+# seconds between reconnects of the notify bridge
+PG_RETRY_SECONDS = 1
+
+
+class Subscription:
+    def __init__(self, maxsize: int):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.dropped = False
+
+    # (type, json data) of the next event, or None once dropped
+    async def get(self) -> tuple[str, str] | None:
+        if self.dropped and self.queue.empty():
+            return None
+        return await self.queue.get()
+
+
+class EventBus:
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self.subscriptions: dict[int, set[Subscription]] = defaultdict(set)
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.bridge: PgNotifyBridge | None = None
+        self._deferred = threading.local()
+
+    # on the event loop, at start up
+    def start(self, engine: Engine | None = None) -> None:
+        self.loop = asyncio.get_running_loop()
+        if engine is not None and self.bridge is None:
+            self.bridge = PgNotifyBridge(engine, self)
+            self.bridge.start()
+
+    # on the event loop
+    def subscribe(self, user_id: int) -> Subscription:
+        subscription = Subscription(self.queue_size)
+        self.subscriptions[user_id].add(subscription)
+        metrics.event_subscriptions.inc()
+        return subscription
+
+    def unsubscribe(self, user_id: int, subscription: Subscription) -> None:
+        subscriptions = self.subscriptions.get(user_id)
+        if subscriptions is not None and subscription in subscriptions:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscriptions[user_id]
+            metrics.event_subscriptions.dec()
+
+    # whether an event of the user may have subscribers, so the publishers
+    # skip building it otherwise
+    def wants(self, user_id: int) -> bool:
+        return self.bridge is not None or user_id in self.subscriptions
+
+    # from any thread
+    def publish(self, user_id: int, event_type: str, data: dict) -> None:
+        pending = getattr(self._deferred, "events", None)
+        if pending is not None:
+            pending.append((user_id, event_type, data))
+        elif self.bridge is not None:
+            self.bridge.send(user_id, event_type, data)
+        elif self.loop is not None:
+            self.loop.call_soon_threadsafe(
+                self.deliver, user_id, event_type, json.dumps(data)
+            )
+
+    # collect the events published by this thread instead, to publish them
+    # once the writes are committed
+    @contextlib.contextmanager
+    def deferred(self):
+        events = []
+        self._deferred.events = events
+        try:
+            yield events
+        finally:
+            self._deferred.events = None
+
+    # on the event loop
+    def deliver(self, user_id: int, event_type: str, data: str) -> None:
+        for subscription in list(self.subscriptions.get(user_id, ())):
+            try:
+                subscription.queue.put_nowait((event_type, data))
+            except asyncio.QueueFull:
+                subscription.dropped = True
+                self.unsubscribe(user_id, subscription)
+                metrics.event_subscriptions_dropped_total.inc()
+                logger.info(f"dropped a slow event subscription of user {user_id}")
+
+
+# cross worker delivery with postgresql LISTEN/NOTIFY, on two dedicated
+# psycopg2 connections out of the pool, one sending the events of this worker
+# and one receiving the events of all workers
+class PgNotifyBridge:
+    def __init__(self, engine: Engine, bus: EventBus):
+        self.engine = engine
+        self.bus = bus
+        self.outbox = queue.SimpleQueue()
+
+    def start(self) -> None:
+        for target, name in ((self._notify, "notify"), (self._listen, "listen")):
+            thread = threading.Thread(target=self._run, args=(target,), daemon=True)
+            thread.name = f"events-{name}"
+            thread.start()
+
+    def send(self, user_id: int, event_type: str, data: dict) -> None:
+        payload = json.dumps({"user_id": user_id, "type": event_type, "data": data})
+        if len(payload.encode()) > PG_MAX_PAYLOAD:
+            data = {**data, "todo": None}
+            payload = json.dumps({"user_id": user_id, "type": event_type, "data": data})
+        self.outbox.put(payload)
+
+    def _connect(self):
+        connection = self.engine.raw_connection()
+        # out of the pool, closed by the bridge
+        connection.detach()
+        dbapi_connection = connection.dbapi_connection
+        dbapi_connection.autocommit = True
+        return dbapi_connection
+
+    def _run(self, target) -> None:
+        while True:
+            try:
+                dbapi_connection = self._connect()
+                try:
+                    target(dbapi_connection)
+                finally:
+                    dbapi_connection.close()
+            except Exception:
+                logger.exception(f"{PG_CHANNEL} bridge failed, reconnecting")
+                time.sleep(PG_RETRY_SECONDS)
+
+    def _notify(self, dbapi_connection) -> None:
+        cursor = dbapi_connection.cursor()
+        while True:
+            payload = self.outbox.get()
+            cursor.execute("SELECT pg_notify(%s, %s)", (PG_CHANNEL, payload))
+
+    def _listen(self, dbapi_connection) -> None:
+        dbapi_connection.cursor().execute(f"LISTEN {PG_CHANNEL}")
+        while True:
+            if select.select([dbapi_connection], [], [], 5) == ([], [], []):
+                continue
+            dbapi_connection.poll()
+            while dbapi_connection.notifies:
+                event = json.loads(dbapi_connection.notifies.pop(0).payload)
+                if self.bus.loop is not None:
+                    self.bus.loop.call_soon_threadsafe(
+                        self.bus.deliver,
+                        event["user_id"],
+                        event["type"],
+                        json.dumps(event["data"]),
+                    )
+
+
+event_bus = EventBus(Config.EVENTS_QUEUE_SIZE)
+
+
+# publish a todo.created, todo.updated or todo.deleted event to the owner,
+# after the write is committed. `todo` is an orm object or a core row, None
+# for deletes
+def publish_todo(event_type: str, owner_id: int | None, id: int, todo=None) -> None:
+    if owner_id is None or not event_bus.wants(owner_id):
+        return
+    if todo is not None:
+        todo = schemas.TodoRead.model_validate(todo).model_dump(mode="json")
+    event_bus.publish(owner_id, f"todo.{event_type}", {"id": id, "todo": todo})
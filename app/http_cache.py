@@ -0,0 +1,73 @@
+# conditional GET (ETag / If-None-Match) and response caching for read
+# endpoints
+#
+# the etag of a response is derived from the versions (updated_at) of the
+# rows it is made of, read with a cheap version query. creates, updates and
+# deletes change the versions, so they invalidate etags and cached responses
+# in every worker without explicit cache invalidation.
+# a matching If-None-Match is answered with 304 Not Modified, otherwise the
+# serialized response body is served from a per worker cache by url and etag,
+# and only built (full query, validation and json encoding) on a miss.
+
+import hashlib
+from typing import Awaitable, Callable
+
+from fastapi import Request, Response, status
+
+from config import Config
+
+from app.cache import TTLCache
+
+response_cache = TTLCache(
+    maxsize=Config.RESPONSE_CACHE_SIZE, ttl=Config.RESPONSE_CACHE_TTL
+)
+
+
+# weak etag, the json body is equivalent but not byte-for-byte guaranteed
+def make_etag(request: Request, versions) -> str:
+    digest = hashlib.sha1(repr((request.url.query, versions)).encode()).hexdigest()
+    return f'W/"{digest[:20]}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # weak comparison, ignore the W/ prefix
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag.removeprefix("W/") in candidates
+
+
+def cached_response(
+    request: Request, versions, build_body: Callable[[], bytes]
+) -> Response:
+    etag = make_etag(request, versions)
+    # clients must revalidate before using a stored response
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    key = (request.url.path, request.url.query, etag)
+    body = response_cache.get(key)
+    if body is None:
+        body = build_body()
+        response_cache.set(key, body)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+async def cached_response_async(
+    request: Request, versions, build_body: Callable[[], Awaitable[bytes]]
+) -> Response:
+    etag = make_etag(request, versions)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    key = (request.url.path, request.url.query, etag)
+    body = response_cache.get(key)
+    if body is None:
+        body = await build_body()
+        response_cache.set(key, body)
+    return Response(body, media_type="application/json", headers=headers)
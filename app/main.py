@@ -1,40 +1,73 @@
+import functools
 import typing
 import os
 from contextlib import asynccontextmanager
 from pathlib import Path
 
 from fastapi import APIRouter, FastAPI, Request, Depends, status
-from fastapi.responses import RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordRequestForm
-from fastapi.templating import Jinja2Templates
 from sqlalchemy.orm import Session
 
 from starsessions import CookieStore, SessionMiddleware
-from starsessions import load_session
+from starsessions import get_session_id, load_session, regenerate_session_id
 
 from config import Config
 
 from app import get_logger
 from app import schemas
 from app import crud
-from app.models import User
-from app.security import authenticate_user
-from app.db import get_db
+from app.cache import TTLCache
+from app.fast_json import FastJSONResponse
+from app import metrics, sql_profiling
+from app.events import event_bus
+from app.session_store import SQLiteSessionStore
+from app.security import (
+    PasswordHashingBusy,
+    auth_cache,
+    principal_cache,
+    authenticate_user,
+)
+from app.db import (
+    async_engine,
+    async_replica_engines,
+    engine,
+    get_db,
+    replica_engines,
+)
 from app.db_migration import reset_tables, update_tables
-from app.routers import auth, todos, users
+from app.routers import auth, events, todos, users
+from app.routers import auth_async, todos_async, users_async
+from app.routers import with_async_routes
 
 logger = get_logger(__name__)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # the server accepts requests, and passes the readiness probe, once the
+    # migration is done, possibly by another process holding the migration
+    # lock, see db_migration.with_lock
     if os.environ.get("RESET_DB"):
         reset_tables()
     elif os.environ.get("UPDATE_DB"):
         update_tables()
+    # todo events are delivered on the event loop, and across the workers with
+    # postgresql LISTEN/NOTIFY if enabled
+    if Config.EVENTS_PG_NOTIFY and engine.dialect.driver == "psycopg2":
+        event_bus.start(engine)
+    else:
+        if Config.EVENTS_PG_NOTIFY:
+            logger.warning("EVENTS_PG_NOTIFY requires postgresql with psycopg2")
+        event_bus.start()
     # yield to boot up the app
     yield
+    if async_engine is not None:
+        await async_engine.dispose()
+    for async_replica_engine in async_replica_engines:
+        await async_replica_engine.dispose()
+    metrics.mark_process_dead()
     # cleanup work after the app has finished
     logger.info("Application has finished.")
 
@@ -47,9 +80,21 @@ app = FastAPI(
     version="0.4.0",
     dependencies=[],
     lifespan=lifespan,
+    # response_model responses are encoded with orjson too in fast json mode
+    default_response_class=FastJSONResponse if Config.FAST_JSON else JSONResponse,
 )
 
 
+# password hash pool is saturated, ask clients to retry shortly
+@app.exception_handler(PasswordHashingBusy)
+async def password_hashing_busy_handler(request: Request, exc: PasswordHashingBusy):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Too many concurrent logins, retry later"},
+        headers={"Retry-After": "1"},
+    )
+
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
@@ -63,9 +108,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# stores session data in a signed cookie on the client.
-# use a strong secret key to sign the cookie for production security
-session_store = CookieStore(secret_key=Config.SECRET_KEY)
+if Config.SESSION_STORE == "sqlite":
+    # stores session data server-side, the cookie only carries the session id
+    session_store = SQLiteSessionStore(Config.SESSION_STORE_PATH)
+else:
+    # stores session data in a signed cookie on the client.
+    # use a strong secret key to sign the cookie for production security
+    session_store = CookieStore(secret_key=Config.SECRET_KEY)
 app.add_middleware(
     SessionMiddleware,
     store=session_store,
@@ -77,6 +126,43 @@ app.add_middleware(
     cookie_https_only=False,
 )
 
+if Config.SQL_PROFILING:
+    app.add_middleware(sql_profiling.SQLProfilingMiddleware)
+if Config.SQL_PROFILING or Config.SLOW_QUERY_MS:
+    sql_profiling.instrument_engine(engine)
+    for replica_engine in replica_engines:
+        sql_profiling.instrument_engine(replica_engine)
+    if async_engine is not None:
+        sql_profiling.instrument_engine(async_engine.sync_engine)
+    for async_replica_engine in async_replica_engines:
+        sql_profiling.instrument_engine(async_replica_engine.sync_engine)
+
+# added last to wrap the other middlewares, and count their time too
+if Config.METRICS_ENABLED:
+    app.add_middleware(metrics.MetricsMiddleware)
+    metrics.instrument_engine(engine)
+    for replica_engine in replica_engines:
+        metrics.instrument_engine(replica_engine)
+    if async_engine is not None:
+        metrics.instrument_engine(async_engine.sync_engine)
+    for async_replica_engine in async_replica_engines:
+        metrics.instrument_engine(async_replica_engine.sync_engine)
+
+
+# logged in users by session id, per worker process
+session_user_cache = TTLCache(maxsize=4096, ttl=Config.PRINCIPAL_CACHE_TTL)
+
+
+# a new session id on login and logout, the session keeps its data. otherwise
+# a session id planted in the victim's browser before the login (session
+# fixation) would be logged in too. the old session is deleted from the store
+async def regenerate_session(request: Request) -> None:
+    session_id = get_session_id(request)
+    if session_id:
+        session_user_cache.delete(session_id)
+        await session_store.remove(session_id)
+    regenerate_session_id(request)
+
 
 # interceptor for current_user from session-based authentication
 # can be depency-injected into template response functions
@@ -90,22 +176,39 @@ async def get_current_user_by_session_id(
     user_id = request.session.get("user_id")
     if user_id is None:
         return None
-    user = crud.get_user(db, user_id)
+    # the session data stays the source of truth for the logged in user id,
+    # the cache only saves the user query on page loads
+    session_id = get_session_id(request)
+    user = session_user_cache.get(session_id)
+    if user is None or user.id != user_id:
+        user = crud.get_user(db, user_id)
+        if user is None:
+            return None
+        user = schemas.UserPrincipal.model_validate(user)
+        session_user_cache.set(session_id, user)
     return user
 
 
-# initialize html templates
+# initialize html templates, on the first web page request, jinja2 is not
+# imported at start up
 BASE_PATH = Path(__file__).resolve().parent
-TEMPLATES = Jinja2Templates(directory=str(BASE_PATH / "templates"))
 
-# Add config to template globals so it's available in all templates
-TEMPLATES.env.globals["config"] = Config
+
+@functools.cache
+def get_templates():
+    from fastapi.templating import Jinja2Templates
+
+    templates = Jinja2Templates(directory=str(BASE_PATH / "templates"))
+    # Add config to template globals so it's available in all templates
+    templates.env.globals["config"] = Config
+    return templates
 
 
 # view routes should be excluded from swagger docs
 @app.get("/home", include_in_schema=False)
 async def home(
-    request: Request, current_user: User = Depends(get_current_user_by_session_id)
+    request: Request,
+    current_user: schemas.UserPrincipal = Depends(get_current_user_by_session_id),
 ):
     logger.debug(f"current_user: {current_user}")
     if current_user is None:
@@ -113,7 +216,7 @@ async def home(
         # set status code 302 to ensure redirect results in a GET request
         return RedirectResponse(redirect_url, status_code=status.HTTP_302_FOUND)
 
-    return TEMPLATES.TemplateResponse(
+    return get_templates().TemplateResponse(
         "todos.html",
         # for TemplateResponse, the context hash must include request object
         {
@@ -130,6 +233,7 @@ async def logout(request: Request):
     # clear user_id from session
     await load_session(request)
     request.session.pop("user_id", None)
+    await regenerate_session(request)
 
     await flash(request, "You have been logged out.", category="warning")
 
@@ -142,7 +246,7 @@ async def logout(request: Request):
 @app.get("/login", include_in_schema=False)
 async def login(request: Request):
     await load_session(request)
-    return TEMPLATES.TemplateResponse(
+    return get_templates().TemplateResponse(
         "login.html",
         {
             "request": request,
@@ -158,14 +262,18 @@ async def post_login(
     db: Session = Depends(get_db),
 ):
     # handle login form submission
-    user = authenticate_user(db, form_data.username, form_data.password)
+    # the user lookup runs on the thread pool like the sync session of get_db,
+    # and bcrypt verification is awaited on the password hash pool, so neither
+    # blocks the event loop
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
-        return TEMPLATES.TemplateResponse(
+        return get_templates().TemplateResponse(
             "login.html", {"request": request}, status_code=status.HTTP_401_UNAUTHORIZED
         )
 
     # update user id in starlette session
     await load_session(request)
+    await regenerate_session(request)
     request.session["user_id"] = user.id
 
     await flash(request, "You have been logged in.", category="success")
@@ -186,18 +294,67 @@ def read_health():
     return {"name": "Todo App with FastAPI", "version": app.version}
 
 
+# prometheus metrics of all workers, see app/metrics.py
+# async, to read the thread pool state on the event loop
+@app.get("/metrics", include_in_schema=False)
+async def read_metrics():
+    content, media_type = metrics.generate_metrics()
+    return Response(content, media_type=media_type)
+
+
+# connection pool usage and checkout metrics of this worker process
+@app.get("/health/db-pool", response_model=schemas.PoolHealthInfo)
+def read_db_pool_health():
+    return {
+        "engine": engine.pool.metrics.snapshot(engine.pool),
+        "async_engine": async_engine.pool.metrics.snapshot(async_engine.pool)
+        if async_engine is not None
+        else None,
+        "replica_engines": [
+            replica_engine.pool.metrics.snapshot(replica_engine.pool)
+            for replica_engine in replica_engines
+        ],
+        "async_replica_engines": [
+            replica_engine.pool.metrics.snapshot(replica_engine.pool)
+            for replica_engine in async_replica_engines
+        ],
+    }
+
+
+# hit/miss counters of the in-process caches of this worker process
+@app.get("/health/caches", response_model=schemas.CachesHealthInfo)
+def read_caches_health():
+    return {
+        "auth": auth_cache.stats(),
+        "principal": principal_cache.stats(),
+        "session_user": session_user_cache.stats(),
+    }
+
+
+# in async mode, api routes run natively on the event loop with async db
+# sessions, instead of on the starlette thread pool
+if Config.SQLALCHEMY_ASYNC:
+    users_router = with_async_routes(users.router, users_async.router)
+    todos_router = with_async_routes(todos.router, todos_async.router)
+    auth_router = with_async_routes(auth.router, auth_async.router)
+else:
+    users_router = users.router
+    todos_router = todos.router
+    auth_router = auth.router
+
 # define an API router with a prefix
 # this allows you to group API routes under a common prefix, like /api
 api_router = APIRouter(prefix=Config.API_PREFIX)
 # use include_router to concatenate sub-routers to the API router
-api_router.include_router(users.router)
-api_router.include_router(todos.router)
+api_router.include_router(users_router)
+api_router.include_router(todos_router)
+api_router.include_router(events.router)
 # mount the API router to the main app
 app.include_router(api_router)
 
 # industrial best practice: separate auth routes from API routes
 # eg. standard OAuth2 endpoints use the /auth or /oauth prefix
-app.include_router(auth.router)
+app.include_router(auth_router)
 
 
 # flash messages helper to push messages to session for one-time display
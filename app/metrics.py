@@ -0,0 +1,188 @@
+# prometheus metrics, served by GET /metrics
+#
+# - per route request count and latency histogram, and in-flight requests
+# - db statements count and time per request, from engine cursor events
+# - password hash (bcrypt) time
+# - starlette thread pool and password hash pool saturation
+#
+# with multiple worker processes (uvicorn --workers, gunicorn), set
+# PROMETHEUS_MULTIPROC_DIR to an empty directory shared by the workers (eg. a
+# k8s emptyDir), each worker then writes its metrics to files there and
+# /metrics aggregates the files of all workers, whichever worker serves it.
+# the directory must be emptied before the workers start.
+
+import os
+import time
+from contextvars import ContextVar
+
+import anyio.to_thread
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import Engine, event
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+MULTIPROCESS = bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+http_requests_total = Counter(
+    "http_requests_total",
+    "HTTP requests by route and status code",
+    ["method", "route", "status"],
+)
+http_request_duration_seconds = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route",
+    ["method", "route"],
+    buckets=LATENCY_BUCKETS,
+)
+http_requests_in_progress = Gauge(
+    "http_requests_in_progress",
+    "HTTP requests being served",
+    multiprocess_mode="livesum",
+)
+http_request_db_statements = Histogram(
+    "http_request_db_statements",
+    "DB statements executed per request by route",
+    ["method", "route"],
+    buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100),
+)
+http_request_db_seconds = Histogram(
+    "http_request_db_seconds",
+    "DB statement time per request by route",
+    ["method", "route"],
+    buckets=LATENCY_BUCKETS,
+)
+password_hash_seconds = Histogram(
+    "password_hash_seconds",
+    "Password hash and verify time, excluding the wait for a pool worker",
+    ["operation"],
+    buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 1, 2),
+)
+threadpool_busy_threads = Gauge(
+    "threadpool_busy_threads",
+    "Starlette thread pool (sync routes and dependencies) threads in use",
+    multiprocess_mode="livesum",
+)
+threadpool_max_threads = Gauge(
+    "threadpool_max_threads",
+    "Starlette thread pool size",
+    multiprocess_mode="livesum",
+)
+password_hash_pending_jobs = Gauge(
+    "password_hash_pending_jobs",
+    "Password hash jobs running or queued on the password hash pool",
+    multiprocess_mode="livesum",
+)
+event_subscriptions = Gauge(
+    "event_subscriptions",
+    "WebSocket and SSE subscriptions of todo events",
+    multiprocess_mode="livesum",
+)
+event_subscriptions_dropped_total = Counter(
+    "event_subscriptions_dropped_total",
+    "Todo event subscriptions dropped for falling behind",
+)
+
+
+# db statements count and time of the current request, a mutable holder set
+# by the middleware, also seen by the sync routes running in the thread pool,
+# which run in a copy of the request context
+class RequestDBStats:
+    __slots__ = ("statements", "seconds")
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+
+
+request_db_stats: ContextVar[RequestDBStats | None] = ContextVar(
+    "request_db_stats", default=None
+)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = request_db_stats.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.seconds += time.perf_counter() - context._metrics_started
+
+
+def instrument_engine(engine: Engine) -> None:
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+# password_hash_pending_jobs is tracked by security.submit_password_hash_job
+def update_threadpool_gauges() -> None:
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    threadpool_busy_threads.set(limiter.borrowed_tokens)
+    threadpool_max_threads.set(limiter.total_tokens)
+
+
+# pure asgi middleware, cheaper than BaseHTTPMiddleware
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status_code = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        stats = RequestDBStats()
+        token = request_db_stats.set(stats)
+        http_requests_in_progress.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = time.perf_counter() - started
+            http_requests_in_progress.dec()
+            request_db_stats.reset(token)
+            # the route path template, set by the router on the scope, keeps
+            # the label cardinality bounded
+            route = scope.get("route")
+            route = route.path if route is not None else "unmatched"
+            method = scope["method"]
+            http_requests_total.labels(method, route, status_code).inc()
+            http_request_duration_seconds.labels(method, route).observe(duration)
+            http_request_db_statements.labels(method, route).observe(stats.statements)
+            http_request_db_seconds.labels(method, route).observe(stats.seconds)
+            update_threadpool_gauges()
+
+
+def generate_metrics() -> tuple[bytes, str]:
+    update_threadpool_gauges()
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+# remove the live gauges of this worker on shutdown, gunicorn users should
+# also call it from the child_exit server hook for crashed workers
+def mark_process_dead(pid: int | None = None) -> None:
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(pid or os.getpid())
@@ -1,6 +1,6 @@
 from datetime import datetime
 
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer, String
+from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Index, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -12,7 +12,13 @@ class AutoTimestampMixin:
     # note that `server_default` takes a SQL expression
     # the python type for these columns is datetime.datetime
     created_at = Column(DateTime, nullable=False, default=lambda: datetime.utcnow())
-    updated_at = Column(DateTime, default=lambda: datetime.utcnow())
+    # onupdate is applied by orm and core (bulk) updates, updated_at is used
+    # as the row version for http caching
+    updated_at = Column(
+        DateTime,
+        default=lambda: datetime.utcnow(),
+        onupdate=lambda: datetime.utcnow(),
+    )
 
 
 class User(Base, AutoTimestampMixin):
@@ -24,11 +30,62 @@ class User(Base, AutoTimestampMixin):
     fname = Column(String)
     todos = relationship("Todo", back_populates="owner", cascade="all, delete-orphan")
 
+    # supports keyset pagination ordered by (created_at, id)
+    __table_args__ = (Index("ix_users_created_at_id", "created_at", "id"),)
+
 
 class Todo(Base, AutoTimestampMixin):
     __tablename__ = "todos"
     id = Column(Integer, primary_key=True, index=True)
-    text = Column(String, index=True)
+    text = Column(String)
     completed = Column(Boolean, default=False)
     owner_id = Column(Integer, ForeignKey("users.id"))
     owner = relationship("User", back_populates="todos")
+    # change version among the todos of the owner, set by triggers, see
+    # app/sync.py
+    version = Column(Integer)
+
+    # support listing ordered by (created_at, id), for all todos, for todos
+    # of one owner, and for todos of one owner filtered by completed status.
+    # the owner_id prefix also serves the owner foreign key lookups
+    __table_args__ = (
+        Index("ix_todos_created_at_id", "created_at", "id"),
+        Index("ix_todos_owner_id_created_at_id", "owner_id", "created_at", "id"),
+        Index(
+            "ix_todos_owner_id_completed_created_at_id",
+            "owner_id",
+            "completed",
+            "created_at",
+            "id",
+        ),
+        # changes of one owner since a version
+        Index("ix_todos_owner_id_version", "owner_id", "version"),
+    )
+
+
+# todo counts per owner, maintained by triggers on todos, see app/stats.py.
+# open todos are total - completed
+class TodoCount(Base):
+    __tablename__ = "todo_counts"
+    owner_id = Column(Integer, primary_key=True, autoincrement=False)
+    total = Column(Integer, nullable=False, default=0)
+    completed = Column(Integer, nullable=False, default=0)
+
+
+# last change version of the todos of an owner, and the version up to which
+# its tombstones were pruned, see app/sync.py
+class TodoVersion(Base):
+    __tablename__ = "todo_versions"
+    owner_id = Column(Integer, primary_key=True, autoincrement=False)
+    version = Column(Integer, nullable=False, default=0)
+    pruned_version = Column(Integer, nullable=False, default=0)
+
+
+# todos deleted, or moved to another owner, with the change version of the
+# owner they were removed from, see app/sync.py
+class TodoTombstone(Base):
+    __tablename__ = "todo_tombstones"
+    owner_id = Column(Integer, primary_key=True, autoincrement=False)
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    todo_id = Column(Integer, nullable=False)
+    deleted_at = Column(DateTime, nullable=False)
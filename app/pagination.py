@@ -0,0 +1,65 @@
+# keyset (cursor) pagination helpers
+#
+# a cursor is an opaque url-safe token encoding the (created_at, id) sort key
+# of the last row of a page, the next page starts right after that row.
+# unlike offset pagination, the db seeks the index to the cursor position
+# instead of scanning and skipping `offset` rows.
+
+import base64
+import json
+from datetime import datetime
+
+from fastapi import HTTPException, status
+
+
+def encode_cursor(created_at: datetime, id: int) -> str:
+    raw = json.dumps([created_at.isoformat(), id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+# an empty cursor requests the first page
+def decode_cursor(cursor: str) -> tuple[datetime, int] | None:
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, id = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(id)
+    except (ValueError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
+        )
+
+
+# cursor of the page following the given rows, None if it's the last page
+def next_cursor(rows: list, limit: int) -> str | None:
+    if len(rows) < limit or not rows:
+        return None
+    last = rows[-1]
+    return encode_cursor(last.created_at, last.id)
+
+
+# search results are ordered by (score, id) instead, see app/search.py
+def encode_score_cursor(score: float, id: int) -> str:
+    raw = json.dumps([score, id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_score_cursor(cursor: str) -> tuple[float, int] | None:
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        score, id = json.loads(raw)
+        return float(score), int(id)
+    except (ValueError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
+        )
+
+
+def next_score_cursor(rows: list, limit: int) -> str | None:
+    if len(rows) < limit or not rows:
+        return None
+    last = rows[-1]
+    return encode_score_cursor(last.score, last.Todo.id)
@@ -0,0 +1,134 @@
+# read replica routing, enabled by Config.SQLALCHEMY_REPLICA_URIS
+#
+# the sessions of GET and HEAD requests read from a replica, everything else
+# runs on the primary:
+# - writes: flushes and insert/update/delete statements, and every statement
+#   of a session after its first write, so it reads its own writes
+# - requests with other methods, which also set a sticky cookie, so the reads
+#   of the same client go to the primary for Config.REPLICA_STICKY_SECONDS,
+#   until the replicas have caught up with its writes
+#
+# a session sticks to one replica, picked round-robin among the healthy
+# ones. replicas are marked down on connection errors, and checked with a
+# `SELECT 1` every Config.REPLICA_CHECK_INTERVAL seconds, reads fall back to
+# the primary when no replica is healthy.
+#
+# async db mode sessions are routed the same, to the async engine of the
+# chosen replica, the health of a replica is shared by its sync and async
+# engines.
+
+import itertools
+import threading
+import time
+
+from sqlalchemy import Engine, event, exc
+from sqlalchemy.engine import ExceptionContext
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.dml import UpdateBase
+
+from app import get_logger
+
+logger = get_logger(__name__)
+
+# requests of a client with this cookie read from the primary
+STICKY_COOKIE = "read_primary"
+
+
+class ReplicaSet:
+    def __init__(self, engines: list[Engine], check_interval: float):
+        self.engines = engines
+        self.check_interval = check_interval
+        self.healthy = {engine: True for engine in engines}
+        self.async_engines: dict[Engine, AsyncEngine] = {}
+        # the replica of the engines reporting errors
+        self._replica_of = {engine: engine for engine in engines}
+        self._counter = itertools.count()
+        self._checker = None
+        self._lock = threading.Lock()
+        for engine in engines:
+            event.listen(engine, "handle_error", self.on_error)
+
+    # the async engine of a replica, for AsyncRoutingSession
+    def add_async_engine(self, engine: Engine, async_engine: AsyncEngine) -> None:
+        self.async_engines[engine] = async_engine
+        self._replica_of[async_engine.sync_engine] = engine
+        event.listen(async_engine.sync_engine, "handle_error", self.on_error)
+
+    # a healthy replica, or None
+    def choose(self) -> Engine | None:
+        if self._checker is None:
+            self._start_checker()
+        healthy = [engine for engine in self.engines if self.healthy[engine]]
+        if not healthy:
+            return None
+        return healthy[next(self._counter) % len(healthy)]
+
+    def set_healthy(self, engine: Engine, healthy: bool) -> None:
+        if self.healthy[engine] != healthy:
+            if healthy:
+                logger.info(f"replica {engine.url!r} is up")
+            else:
+                logger.warning(f"replica {engine.url!r} is down")
+        self.healthy[engine] = healthy
+
+    # connection errors of a replica, including failed connects
+    def on_error(self, context: ExceptionContext) -> None:
+        if context.is_disconnect or isinstance(
+            context.sqlalchemy_exception, (exc.OperationalError, exc.InterfaceError)
+        ):
+            self.set_healthy(self._replica_of[context.engine], False)
+
+    def check(self) -> None:
+        for engine in self.engines:
+            try:
+                with engine.connect() as conn:
+                    conn.exec_driver_sql("SELECT 1")
+            except exc.DBAPIError:
+                self.set_healthy(engine, False)
+            else:
+                self.set_healthy(engine, True)
+
+    def _start_checker(self) -> None:
+        with self._lock:
+            if self._checker is not None:
+                return
+
+            def run():
+                while True:
+                    time.sleep(self.check_interval)
+                    self.check()
+
+            self._checker = threading.Thread(
+                target=run, name="replica-check", daemon=True
+            )
+            self._checker.start()
+
+
+class RoutingSession(Session):
+    def __init__(self, *args, replicas: ReplicaSet | None = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.replicas = replicas
+        # set by get_db for the requests allowed to read from a replica
+        self.use_replica = False
+        self._replica = None
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.use_replica = False
+        if self.use_replica and self.replicas is not None:
+            if self._replica is None or not self.replicas.healthy[self._replica]:
+                self._replica = self.replicas.choose()
+            if self._replica is not None:
+                return self.replica_bind(self._replica)
+        return super().get_bind(mapper, clause=clause, **kwargs)
+
+    def replica_bind(self, replica: Engine) -> Engine:
+        return replica
+
+
+# the sync session of the AsyncSession of async db mode, which runs on the
+# sync facade of the async engines
+class AsyncRoutingSession(RoutingSession):
+    def replica_bind(self, replica: Engine) -> Engine:
+        return self.replicas.async_engines[replica].sync_engine
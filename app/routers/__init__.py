@@ -0,0 +1,21 @@
+from fastapi import APIRouter
+from fastapi.routing import APIRoute
+
+
+# swap in async handlers for the routes of a sync router, eg. when
+# Config.SQLALCHEMY_ASYNC is enabled.
+# routes are matched by path and methods, and the sync router's route order
+# is kept, so path matching precedence doesn't change. sync routes without
+# an async counterpart are kept as they are.
+def with_async_routes(sync_router: APIRouter, async_router: APIRouter) -> APIRouter:
+    async_routes = {
+        (route.path, frozenset(route.methods)): route
+        for route in async_router.routes
+        if isinstance(route, APIRoute)
+    }
+    router = APIRouter()
+    for route in sync_router.routes:
+        if isinstance(route, APIRoute):
+            route = async_routes.get((route.path, frozenset(route.methods)), route)
+        router.routes.append(route)
+    return router
@@ -2,30 +2,30 @@ from datetime import timedelta
 
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security.oauth2 import OAuth2PasswordRequestForm
-from jose import JWTError
 from sqlalchemy.orm import Session
 
 from config import Config
 from app import schemas
 from app import crud
 from app.db import get_db
-from app.models import User
 from app.security import (
     ACCESS_TOKEN_EXPIRE_MINUTES,
+    InvalidToken,
     authenticate_user,
     create_access_token,
     decode_access_token,
+    principal_cache,
 )
 
 router = APIRouter(prefix="/auth", dependencies=[], tags=["Auth"])
 
 
 @router.post("/token", response_model=schemas.Token)
-def login_for_token(
+async def login_for_token(
     form_data: OAuth2PasswordRequestForm = Depends(OAuth2PasswordRequestForm),
     db: Session = Depends(get_db),
 ):
-    user = authenticate_user(db, form_data.username, form_data.password)
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -59,16 +59,21 @@ def get_current_user_by_token(
         email: str = payload.get("sub")
         if email is None:
             raise credentials_exception
-    except JWTError:
+    except InvalidToken:
         raise credentials_exception
-    user = crud.get_user_by_email(db, email=email)
-    if user is None:
-        raise credentials_exception
-    return user
+    # the cached principal saves the user query on every authenticated call
+    principal = principal_cache.get(email)
+    if principal is None:
+        user = crud.get_user_by_email(db, email=email)
+        if user is None:
+            raise credentials_exception
+        principal = schemas.UserPrincipal.model_validate(user)
+        principal_cache.set(email, principal)
+    return principal
 
 
 @router.get("/me", response_model=schemas.UserRead)
 def read_logged_in_user(
-    current_user: User = Depends(get_current_user_by_token),
+    current_user: schemas.UserPrincipal = Depends(get_current_user_by_token),
 ):
     return current_user
@@ -0,0 +1,75 @@
+# async mirror of routers/auth.py, used when Config.SQLALCHEMY_ASYNC is enabled
+
+from datetime import timedelta
+
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.security.oauth2 import OAuth2PasswordRequestForm
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import schemas
+from app import crud_async as crud
+from app.db import get_async_db
+from app.security import (
+    ACCESS_TOKEN_EXPIRE_MINUTES,
+    InvalidToken,
+    authenticate_user_async,
+    create_access_token,
+    decode_access_token,
+    principal_cache,
+)
+
+router = APIRouter(prefix="/auth", dependencies=[], tags=["Auth"])
+
+
+@router.post("/token", response_model=schemas.Token)
+async def login_for_token(
+    form_data: OAuth2PasswordRequestForm = Depends(OAuth2PasswordRequestForm),
+    db: AsyncSession = Depends(get_async_db),
+):
+    user = await authenticate_user_async(db, form_data.username, form_data.password)
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Incorrect email or password",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    access_token = create_access_token(
+        data={"sub": user.email},
+        expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),
+    )
+    return {"access_token": access_token, "token_type": "bearer"}
+
+
+# async version of auth.get_current_user_by_token
+async def get_current_user_by_token(
+    token: str = Depends(schemas.oauth2_password_scheme),
+    db: AsyncSession = Depends(get_async_db),
+):
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid authentication credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    try:
+        payload = decode_access_token(token)
+        email: str = payload.get("sub")
+        if email is None:
+            raise credentials_exception
+    except InvalidToken:
+        raise credentials_exception
+    # the cached principal saves the user query on every authenticated call
+    principal = principal_cache.get(email)
+    if principal is None:
+        user = await crud.get_user_by_email(db, email=email)
+        if user is None:
+            raise credentials_exception
+        principal = schemas.UserPrincipal.model_validate(user)
+        principal_cache.set(email, principal)
+    return principal
+
+
+@router.get("/me", response_model=schemas.UserRead)
+async def read_logged_in_user(
+    current_user: schemas.UserPrincipal = Depends(get_current_user_by_token),
+):
+    return current_user
@@ -0,0 +1,130 @@
+# push of the current user's todo changes, as server-sent events or over a
+# WebSocket, instead of polling, see app/events.py
+#
+# events have a type, todo.created, todo.updated or todo.deleted, and json
+# data with the todo id and the todo (TodoRead, None for deletes). events are
+# not replayed: clients catch up with GET /todos/changes when they connect,
+# and when their subscription is dropped for falling behind, which ends the
+# SSE stream with a `dropped` event, and closes the WebSocket with code 1013.
+#
+# browsers can't set the Authorization header of EventSource and WebSocket
+# requests, the bearer token can be passed in the `token` query parameter.
+
+import asyncio
+
+from fastapi import APIRouter, Depends, HTTPException, WebSocket, status
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import HTTPConnection
+from starlette.websockets import WebSocketDisconnect
+
+from app import schemas
+from app.db import SessionLocal
+from app.events import event_bus
+from app.routers.auth import get_current_user_by_token
+
+router = APIRouter(prefix="/events", dependencies=[], tags=["Events"])
+
+# seconds between SSE comments, which keep proxies from closing idle streams
+SSE_KEEPALIVE_SECONDS = 15
+
+
+# the user of the bearer token, None when missing or invalid
+async def get_subscriber(
+    connection: HTTPConnection, token: str | None = None
+) -> schemas.UserPrincipal | None:
+    scheme, _, credentials = connection.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and credentials:
+        token = credentials
+    if not token:
+        return None
+
+    # the principal is usually cached, or takes a user query
+    def authenticate():
+        with SessionLocal() as db:
+            try:
+                return get_current_user_by_token(token, db)
+            except HTTPException:
+                return None
+
+    return await run_in_threadpool(authenticate)
+
+
+@router.get("/", response_class=StreamingResponse)
+async def stream_todo_events(
+    subscriber: schemas.UserPrincipal | None = Depends(get_subscriber),
+):
+    if subscriber is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid authentication credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    subscription = event_bus.subscribe(subscriber.id)
+
+    # unsubscribed when the client disconnects, which cancels the stream
+    async def stream():
+        try:
+            yield ": subscribed\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(
+                        subscription.get(), SSE_KEEPALIVE_SECONDS
+                    )
+                except TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if event is None:
+                    yield "event: dropped\ndata: {}\n\n"
+                    return
+                event_type, data = event
+                yield f"event: {event_type}\ndata: {data}\n\n"
+        finally:
+            event_bus.unsubscribe(subscriber.id, subscription)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        # no proxy buffering nor caching of the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# sends {"type": ..., "data": ...} json messages, messages from the client
+# are ignored
+@router.websocket("/ws")
+async def websocket_todo_events(
+    websocket: WebSocket,
+    subscriber: schemas.UserPrincipal | None = Depends(get_subscriber),
+):
+    if subscriber is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    subscription = event_bus.subscribe(subscriber.id)
+    # the client closing the connection ends the receive task
+    receive = asyncio.ensure_future(websocket.receive())
+    try:
+        while True:
+            get = asyncio.ensure_future(subscription.get())
+            await asyncio.wait({get, receive}, return_when=asyncio.FIRST_COMPLETED)
+            if not get.done():
+                get.cancel()
+                message = receive.result()
+                if message["type"] == "websocket.disconnect":
+                    return
+                receive = asyncio.ensure_future(websocket.receive())
+                continue
+            event = get.result()
+            if event is None:
+                await websocket.close(
+                    code=status.WS_1013_TRY_AGAIN_LATER, reason="dropped"
+                )
+                return
+            event_type, data = event
+            await websocket.send_text(f'{{"type": "{event_type}", "data": {data}}}')
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receive.cancel()
+        event_bus.unsubscribe(subscriber.id, subscription)
@@ -1,47 +1,259 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from typing import Literal
+
+import anyio
+from fastapi import APIRouter, Body, Depends, HTTPException, Query, Request, status
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 
-from app.db import get_db
+from app.db import engine, get_db
+from config import Config
 
+from app.http_cache import cached_response
+from app.pagination import (
+    decode_cursor,
+    decode_score_cursor,
+    next_cursor,
+    next_score_cursor,
+)
+from app import bulk_import, fast_json
 from app import crud, schemas
-from app.models import User
 from app.routers.auth import get_current_user_by_token
+from app.write_queue import run_write
 
 router = APIRouter(prefix="/todos", dependencies=[], tags=["Todos"])
 
 
 # @router.get("/", response_model=list[schemas.TodoReadNested])
-@router.get("/", response_model=list[schemas.TodoRead])
+# offset pagination by default, keyset pagination when `cursor` is given,
+# pass an empty cursor (`?cursor=`) to fetch the first page
+@router.get("/", response_model=list[schemas.TodoRead] | schemas.TodoPage)
 def read_todos(
+    request: Request,
     # user_id: int = Query(None, title="User ID", description="The ID of the user associated to the todos to view"),
     user_id: int | None = None,
     offset: int = 0,
     limit: int = 10,
+    cursor: str | None = None,
+    # filter by completed status, only applies to todos of `user_id`
+    completed: bool | None = None,
+    db: Session = Depends(get_db),
+):
+    after = decode_cursor(cursor) if cursor is not None else None
+    # polling clients revalidate with If-None-Match against the page versions
+    versions = crud.get_todos_versions(
+        db,
+        user_id=user_id,
+        completed=completed,
+        after=after,
+        offset=offset if cursor is None else 0,
+        limit=limit,
+    )
+
+    def build_body() -> bytes:
+        if Config.FAST_JSON:
+            rows = crud.get_todos_rows(
+                db,
+                user_id=user_id,
+                completed=completed,
+                after=after,
+                offset=offset if cursor is None else 0,
+                limit=limit,
+            )
+            if cursor is not None:
+                return fast_json.page_json(rows, fast_json.TODO_READ_FIELDS, limit)
+            return fast_json.rows_json(rows, fast_json.TODO_READ_FIELDS)
+        if cursor is not None:
+            if user_id:
+                todos = crud.get_user_todos_keyset(
+                    db, user_id, after, limit=limit, completed=completed
+                )
+            else:
+                todos = crud.get_todos_keyset(db, after, limit=limit)
+            page = schemas.TodoPage.model_validate(
+                {"items": todos, "next_cursor": next_cursor(todos, limit)},
+                from_attributes=True,
+            )
+            return page.model_dump_json().encode()
+        if user_id:
+            todos = crud.get_user_todos(
+                db, user_id, offset=offset, limit=limit, completed=completed
+            )
+        else:
+            todos = crud.get_todos(db, offset=offset, limit=limit)
+        return schemas.TodoReadList.dump_json(
+            schemas.TodoReadList.validate_python(todos, from_attributes=True)
+        )
+
+    return cached_response(request, versions, build_body)
+
+
+# secured by token, full-text search of the current user's todos, ranked by
+# relevance and paginated by cursor like the keyset list, see app/search.py.
+# declared before the /{id} routes
+@router.get("/search", response_model=schemas.TodoPage)
+def search_todos(
+    # at least one non-whitespace character, blank queries have no terms
+    q: str = Query(min_length=1, max_length=200, pattern=r"\S"),
+    limit: int = 10,
+    cursor: str | None = None,
+    current_user: schemas.UserPrincipal = Depends(get_current_user_by_token),
+    db: Session = Depends(get_db),
+):
+    after = decode_score_cursor(cursor) if cursor is not None else None
+    rows = crud.search_todos(db, current_user.id, q, after, limit=limit)
+    return {
+        "items": [row.Todo for row in rows],
+        "next_cursor": next_score_cursor(rows, limit),
+    }
+
+
+# secured by token, the changes of the current user's todos since a version:
+# the todos created or updated, and the ids of the todos deleted, in version
+# order, see app/sync.py. `since=0` returns all the todos, then clients pass
+# the returned `since` until `has_more` is false, and later to sync again.
+# 410 when tombstones newer than `since` were pruned, sync again from 0.
+# declared before the /{id} routes
+@router.get("/changes", response_model=schemas.TodoChanges)
+def read_todo_changes(
+    since: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=Config.SYNC_CHANGES_LIMIT),
+    current_user: schemas.UserPrincipal = Depends(get_current_user_by_token),
     db: Session = Depends(get_db),
 ):
-    if user_id:
-        todos = crud.get_user_todos(db, user_id, offset=offset, limit=limit)
-    else:
-        todos = crud.get_todos(db, offset=offset, limit=limit)
-    return todos
+    sync_version = crud.get_sync_version(db, current_user.id)
+    if sync_version is not None and 0 < since < sync_version.pruned_version:
+        raise HTTPException(
+            status_code=status.HTTP_410_GONE,
+            detail="Changes since this version were pruned, sync again from 0",
+        )
+    # the usual poll, nothing changed since
+    if sync_version is None or since >= sync_version.version:
+        return {"changes": [], "since": since, "has_more": False}
+    changes = crud.get_todo_changes(db, current_user.id, since, limit)
+    return {
+        "changes": changes,
+        "since": changes[-1]["version"] if changes else since,
+        "has_more": len(changes) == limit,
+    }
+
+
+# todo counts of all users, from the counters maintained by app/stats.py and
+# cached for Config.STATS_CACHE_TTL. declared before the /{id} routes
+@router.get("/stats", response_model=schemas.TodoStats)
+def read_todo_stats(db: Session = Depends(get_db)):
+    return crud.get_todo_stats(db)
+
+
+# batch routes must be declared before the /{id} routes, otherwise "batch"
+# is matched as an id
+# secured by token
+@router.post(
+    "/batch",
+    response_model=list[schemas.TodoBatchResult],
+    status_code=status.HTTP_201_CREATED,
+)
+def create_todos(
+    todos_data: list[schemas.TodoCreate] = Body(max_length=Config.BATCH_LIMIT),
+    current_user: schemas.UserPrincipal = Depends(get_current_user_by_token),
+    db: Session = Depends(get_db),
+):
+    rows = run_write(db, crud.create_todos, current_user, todos_data)
+    return [
+        {"id": row.id, "status": status.HTTP_201_CREATED, "todo": row} for row in rows
+    ]
+
+
+# secured by token, only todos of the current user are updated
+@router.put("/batch", response_model=list[schemas.TodoBatchResult])
+def update_todos(
+    todos_data: list[schemas.TodoUpdate] = Body(max_length=Config.BATCH_LIMIT),
+    current_user: schemas.UserPrincipal = Depends(get_current_user_by_token),
+    db: Session = Depends(get_db),
+):
+    rows = run_write(db, crud.update_todos, current_user, todos_data)
+    return [
+        {"id": todo_data.id, "status": status.HTTP_200_OK, "todo": rows[todo_data.id]}
+        if todo_data.id in rows
+        else {
+            "id": todo_data.id,
+            "status": status.HTTP_404_NOT_FOUND,
+            "detail": "Todo not found",
+        }
+        for todo_data in todos_data
+    ]
+
+
+# secured by token, only todos of the current user are deleted
+@router.delete("/batch", response_model=list[schemas.TodoBatchResult])
+def delete_todos(
+    ids: list[int] = Body(max_length=Config.BATCH_LIMIT),
+    current_user: schemas.UserPrincipal = Depends(get_current_user_by_token),
+    db: Session = Depends(get_db),
+):
+    deleted_ids = run_write(db, crud.delete_todos, current_user, ids)
+    return [
+        {"id": id, "status": status.HTTP_204_NO_CONTENT}
+        if id in deleted_ids
+        else {"id": id, "status": status.HTTP_404_NOT_FOUND, "detail": "Todo not found"}
+        for id in ids
+    ]
+
+
+# secured by token, bulk import todos of the current user from an ndjson or
+# csv request body, parsed and inserted in chunks as it's received, see
+# app/bulk_import.py. runs in a worker thread with the sync engine, in async
+# db mode too
+@router.post("/import", response_model=schemas.TodoImportResult)
+async def import_todos(
+    request: Request,
+    format: Literal["ndjson", "csv"] = "ndjson",
+    current_user: schemas.UserPrincipal = Depends(get_current_user_by_token),
+):
+    body = request.stream()
+
+    async def next_chunk() -> bytes | None:
+        try:
+            return await body.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    # pull the body chunks from the event loop into the worker thread
+    def read_body():
+        while (chunk := anyio.from_thread.run(next_chunk)) is not None:
+            yield chunk
+
+    records = bulk_import.PARSERS[format](bulk_import.iter_lines(read_body()))
+    return await run_in_threadpool(
+        bulk_import.import_todos,
+        engine,
+        records,
+        owner_id=current_user.id,
+        force_owner=True,
+        progress=bulk_import.log_progress,
+    )
 
 
 # @router.get("/{id}", response_model=schemas.TodoRead)
 @router.get("/{id}", response_model=schemas.TodoReadNested)
-def read_todo(id: int, db: Session = Depends(get_db)):
-    todo = crud.get_todo(db, id)
-    if not todo:
+def read_todo(id: int, request: Request, db: Session = Depends(get_db)):
+    version = crud.get_todo_version(db, id)
+    if not version:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Todo not found"
         )
-    return todo
+
+    def build_body() -> bytes:
+        todo = crud.get_todo(db, id)
+        return schemas.TodoReadNested.model_validate(todo).model_dump_json().encode()
+
+    return cached_response(request, tuple(version), build_body)
 
 
 # secured by token
 @router.post("/", response_model=schemas.TodoRead, status_code=status.HTTP_201_CREATED)
 def create_todo(
     todo_data: schemas.TodoCreate,
-    current_user: User = Depends(get_current_user_by_token),
+    current_user: schemas.UserPrincipal = Depends(get_current_user_by_token),
     db: Session = Depends(get_db),
 ):
     owner = current_user
@@ -50,7 +262,7 @@ def create_todo(
             status_code=status.HTTP_404_NOT_FOUND, detail="Owner not found"
         )
 
-    todo = crud.create_todo(db, owner, todo_data)
+    todo = run_write(db, crud.create_todo, owner, todo_data)
     return todo
 
 
@@ -59,8 +271,8 @@ def create_todo(
 def update_todo(
     id: int,
     todo_data: schemas.TodoUpdate,
-    current_user: User = Depends(get_current_user_by_token),
+    current_user: schemas.UserPrincipal = Depends(get_current_user_by_token),
     db: Session = Depends(get_db),
 ):
-    todo = crud.update_todo(db, id, todo_data)
+    todo = run_write(db, crud.update_todo, id, todo_data)
     return todo
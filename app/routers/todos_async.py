@@ -0,0 +1,191 @@
+# async mirror of routers/todos.py, used when Config.SQLALCHEMY_ASYNC is enabled
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db import get_async_db
+from config import Config
+
+from app.http_cache import cached_response_async
+from app.pagination import (
+    decode_cursor,
+    decode_score_cursor,
+    next_cursor,
+    next_score_cursor,
+)
+from app import fast_json
+from app import crud as sync_crud
+from app import crud_async as crud, schemas
+from app.routers.auth_async import get_current_user_by_token
+from app.write_queue import write_queue
+
+router = APIRouter(prefix="/todos", dependencies=[], tags=["Todos"])
+
+
+@router.get("/", response_model=list[schemas.TodoRead] | schemas.TodoPage)
+async def read_todos(
+    request: Request,
+    user_id: int | None = None,
+    offset: int = 0,
+    limit: int = 10,
+    cursor: str | None = None,
+    # filter by completed status, only applies to todos of `user_id`
+    completed: bool | None = None,
+    db: AsyncSession = Depends(get_async_db),
+):
+    after = decode_cursor(cursor) if cursor is not None else None
+    # polling clients revalidate with If-None-Match against the page versions
+    versions = await crud.get_todos_versions(
+        db,
+        user_id=user_id,
+        completed=completed,
+        after=after,
+        offset=offset if cursor is None else 0,
+        limit=limit,
+    )
+
+    async def build_body() -> bytes:
+        if Config.FAST_JSON:
+            rows = await crud.get_todos_rows(
+                db,
+                user_id=user_id,
+                completed=completed,
+                after=after,
+                offset=offset if cursor is None else 0,
+                limit=limit,
+            )
+            if cursor is not None:
+                return fast_json.page_json(rows, fast_json.TODO_READ_FIELDS, limit)
+            return fast_json.rows_json(rows, fast_json.TODO_READ_FIELDS)
+        if cursor is not None:
+            if user_id:
+                todos = await crud.get_user_todos_keyset(
+                    db, user_id, after, limit=limit, completed=completed
+                )
+            else:
+                todos = await crud.get_todos_keyset(db, after, limit=limit)
+            page = schemas.TodoPage.model_validate(
+                {"items": todos, "next_cursor": next_cursor(todos, limit)},
+                from_attributes=True,
+            )
+            return page.model_dump_json().encode()
+        if user_id:
+            todos = await crud.get_user_todos(
+                db, user_id, offset=offset, limit=limit, completed=completed
+            )
+        else:
+            todos = await crud.get_todos(db, offset=offset, limit=limit)
+        return schemas.TodoReadList.dump_json(
+            schemas.TodoReadList.validate_python(todos, from_attributes=True)
+        )
+
+    return await cached_response_async(request, versions, build_body)
+
+
+# secured by token, full-text search of the current user's todos, ranked by
+# relevance and paginated by cursor like the keyset list, see app/search.py.
+# declared before the /{id} routes
+@router.get("/search", response_model=schemas.TodoPage)
+async def search_todos(
+    # at least one non-whitespace character, blank queries have no terms
+    q: str = Query(min_length=1, max_length=200, pattern=r"\S"),
+    limit: int = 10,
+    cursor: str | None = None,
+    current_user: schemas.UserPrincipal = Depends(get_current_user_by_token),
+    db: AsyncSession = Depends(get_async_db),
+):
+    after = decode_score_cursor(cursor) if cursor is not None else None
+    rows = await crud.search_todos(db, current_user.id, q, after, limit=limit)
+    return {
+        "items": [row.Todo for row in rows],
+        "next_cursor": next_score_cursor(rows, limit),
+    }
+
+
+# secured by token, the changes of the current user's todos since a version:
+# the todos created or updated, and the ids of the todos deleted, in version
+# order, see app/sync.py. `since=0` returns all the todos, then clients pass
+# the returned `since` until `has_more` is false, and later to sync again.
+# 410 when tombstones newer than `since` were pruned, sync again from 0.
+# declared before the /{id} routes
+@router.get("/changes", response_model=schemas.TodoChanges)
+async def read_todo_changes(
+    since: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=Config.SYNC_CHANGES_LIMIT),
+    current_user: schemas.UserPrincipal = Depends(get_current_user_by_token),
+    db: AsyncSession = Depends(get_async_db),
+):
+    sync_version = await crud.get_sync_version(db, current_user.id)
+    if sync_version is not None and 0 < since < sync_version.pruned_version:
+        raise HTTPException(
+            status_code=status.HTTP_410_GONE,
+            detail="Changes since this version were pruned, sync again from 0",
+        )
+    # the usual poll, nothing changed since
+    if sync_version is None or since >= sync_version.version:
+        return {"changes": [], "since": since, "has_more": False}
+    changes = await crud.get_todo_changes(db, current_user.id, since, limit)
+    return {
+        "changes": changes,
+        "since": changes[-1]["version"] if changes else since,
+        "has_more": len(changes) == limit,
+    }
+
+
+# todo counts of all users, from the counters maintained by app/stats.py and
+# cached for Config.STATS_CACHE_TTL. declared before the /{id} routes
+@router.get("/stats", response_model=schemas.TodoStats)
+async def read_todo_stats(db: AsyncSession = Depends(get_async_db)):
+    return await crud.get_todo_stats(db)
+
+
+@router.get("/{id}", response_model=schemas.TodoReadNested)
+async def read_todo(
+    id: int, request: Request, db: AsyncSession = Depends(get_async_db)
+):
+    version = await crud.get_todo_version(db, id)
+    if not version:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Todo not found"
+        )
+
+    async def build_body() -> bytes:
+        todo = await crud.get_todo(db, id)
+        return schemas.TodoReadNested.model_validate(todo).model_dump_json().encode()
+
+    return await cached_response_async(request, tuple(version), build_body)
+
+
+# secured by token
+@router.post("/", response_model=schemas.TodoRead, status_code=status.HTTP_201_CREATED)
+async def create_todo(
+    todo_data: schemas.TodoCreate,
+    current_user: schemas.UserPrincipal = Depends(get_current_user_by_token),
+    db: AsyncSession = Depends(get_async_db),
+):
+    owner = current_user
+    if not owner:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Owner not found"
+        )
+
+    if write_queue is not None:
+        todo = await write_queue.run_async(sync_crud.create_todo, owner, todo_data)
+    else:
+        todo = await crud.create_todo(db, owner, todo_data)
+    return todo
+
+
+# secured by token
+@router.put("/{id}", response_model=schemas.TodoRead, status_code=status.HTTP_200_OK)
+async def update_todo(
+    id: int,
+    todo_data: schemas.TodoUpdate,
+    current_user: schemas.UserPrincipal = Depends(get_current_user_by_token),
+    db: AsyncSession = Depends(get_async_db),
+):
+    if write_queue is not None:
+        todo = await write_queue.run_async(sync_crud.update_todo, id, todo_data)
+    else:
+        todo = await crud.update_todo(db, id, todo_data)
+    return todo
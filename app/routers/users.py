@@ -1,49 +1,118 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from typing import Literal
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 
 from app.db import get_db
 from config import Config
 
+from app.pagination import decode_cursor, next_cursor
+from app import fast_json
+from app import export
 from app import crud, schemas
-from app.models import User
 from app.routers.auth import get_current_user_by_token
+from app.security import get_password_hash_async
 
 router = APIRouter(prefix="/users", dependencies=[], tags=["Users"])
 
 
+# the sync session is used on the thread pool, and the password hashing is
+# awaited, so no thread waits on the password hash pool
 @router.post("/signup", response_model=schemas.UserRead)
-def signup(user_data: schemas.UserCreate, db: Session = Depends(get_db)):
-    user = crud.get_user_by_email(db, user_data.email)
+async def signup(user_data: schemas.UserCreate, db: Session = Depends(get_db)):
+    user = await run_in_threadpool(crud.get_user_by_email, db, user_data.email)
     if user:
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT, detail="Email already registered."
         )
-    signed_up_user = crud.create_user(db, user_data)
+    hashed_password = await get_password_hash_async(user_data.password)
+    signed_up_user = await run_in_threadpool(
+        crud.create_user, db, user_data, hashed_password
+    )
     return signed_up_user
 
 
 # @router.get("/", response_model=list[schemas.TodoReadNested])
-@router.get("/", response_model=list[schemas.UserRead])
+# offset pagination by default, keyset pagination when `cursor` is given
+@router.get("/", response_model=list[schemas.UserRead] | schemas.UserPage)
 def read_users(
-    logged_in_user: User = Depends(get_current_user_by_token),
+    logged_in_user: schemas.UserPrincipal = Depends(get_current_user_by_token),
     offset: int = 0,
     limit: int = 10,
+    cursor: str | None = None,
     db: Session = Depends(get_db),
 ):
+    after = decode_cursor(cursor) if cursor is not None else None
+    if Config.FAST_JSON:
+        rows = crud.get_users_rows(
+            db, after=after, offset=offset if cursor is None else 0, limit=limit
+        )
+        if cursor is not None:
+            content = fast_json.page_json(rows, fast_json.USER_READ_FIELDS, limit)
+        else:
+            content = fast_json.rows_json(rows, fast_json.USER_READ_FIELDS)
+        return Response(content, media_type="application/json")
+    if cursor is not None:
+        users = crud.get_users_keyset(db, after, limit=limit)
+        return {"items": users, "next_cursor": next_cursor(users, limit)}
     users = crud.get_users(db, offset=offset, limit=limit)
-    return users
+    # validated and encoded by the precompiled adapter
+    content = schemas.UserReadList.dump_json(
+        schemas.UserReadList.validate_python(users, from_attributes=True)
+    )
+    return Response(content, media_type="application/json")
 
 
 # @router.get("/{id}", response_model=schemas.TodoRead)
 @router.get("/{id}", response_model=schemas.UserReadNested)
 def read_user(
     id: int,
-    logged_in_user: User = Depends(get_current_user_by_token),
+    todos_limit: int = Query(10, ge=1, le=Config.NESTED_TODOS_LIMIT),
+    logged_in_user: schemas.UserPrincipal = Depends(get_current_user_by_token),
     db: Session = Depends(get_db),
 ):
-    user = crud.get_user(db, id)
+    user = crud.get_user_with_todos(db, id, todos_limit=todos_limit)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="User not found"
         )
-    return user
+    response = schemas.UserReadNested.model_validate(user)
+    response.todos_next_cursor = next_cursor(user.todos, todos_limit)
+    return response
+
+
+# todo counts of a user, a primary key lookup of the counters maintained by
+# app/stats.py
+@router.get("/{id}/todos/stats", response_model=schemas.TodoStats)
+def read_user_todo_stats(
+    id: int,
+    logged_in_user: schemas.UserPrincipal = Depends(get_current_user_by_token),
+    db: Session = Depends(get_db),
+):
+    stats = crud.get_user_todo_stats(db, id)
+    if not stats["total"] and not crud.get_user(db, id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="User not found"
+        )
+    return stats
+
+
+# stream all todos of a user as ndjson (one TodoRead json per line) or csv
+@router.get("/{id}/todos/export", response_class=StreamingResponse)
+def export_user_todos(
+    id: int,
+    format: Literal["ndjson", "csv"] = "ndjson",
+    logged_in_user: schemas.UserPrincipal = Depends(get_current_user_by_token),
+    db: Session = Depends(get_db),
+):
+    if not crud.get_user(db, id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="User not found"
+        )
+    return StreamingResponse(
+        export.export_user_todos(id, format),
+        media_type=export.MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="todos-{id}.{format}"'},
+    )
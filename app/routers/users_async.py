@@ -0,0 +1,112 @@
+# async mirror of routers/users.py, used when Config.SQLALCHEMY_ASYNC is enabled
+
+from typing import Literal
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db import get_async_db
+from config import Config
+
+from app.pagination import decode_cursor, next_cursor
+from app import fast_json
+from app import export
+from app import crud_async as crud, schemas
+from app.routers.auth_async import get_current_user_by_token
+
+router = APIRouter(prefix="/users", dependencies=[], tags=["Users"])
+
+
+@router.post("/signup", response_model=schemas.UserRead)
+async def signup(
+    user_data: schemas.UserCreate, db: AsyncSession = Depends(get_async_db)
+):
+    user = await crud.get_user_by_email(db, user_data.email)
+    if user:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail="Email already registered."
+        )
+    signed_up_user = await crud.create_user(db, user_data)
+    return signed_up_user
+
+
+@router.get("/", response_model=list[schemas.UserRead] | schemas.UserPage)
+async def read_users(
+    logged_in_user: schemas.UserPrincipal = Depends(get_current_user_by_token),
+    offset: int = 0,
+    limit: int = 10,
+    cursor: str | None = None,
+    db: AsyncSession = Depends(get_async_db),
+):
+    after = decode_cursor(cursor) if cursor is not None else None
+    if Config.FAST_JSON:
+        rows = await crud.get_users_rows(
+            db, after=after, offset=offset if cursor is None else 0, limit=limit
+        )
+        if cursor is not None:
+            content = fast_json.page_json(rows, fast_json.USER_READ_FIELDS, limit)
+        else:
+            content = fast_json.rows_json(rows, fast_json.USER_READ_FIELDS)
+        return Response(content, media_type="application/json")
+    if cursor is not None:
+        users = await crud.get_users_keyset(db, after, limit=limit)
+        return {"items": users, "next_cursor": next_cursor(users, limit)}
+    users = await crud.get_users(db, offset=offset, limit=limit)
+    # validated and encoded by the precompiled adapter
+    content = schemas.UserReadList.dump_json(
+        schemas.UserReadList.validate_python(users, from_attributes=True)
+    )
+    return Response(content, media_type="application/json")
+
+
+@router.get("/{id}", response_model=schemas.UserReadNested)
+async def read_user(
+    id: int,
+    todos_limit: int = Query(10, ge=1, le=Config.NESTED_TODOS_LIMIT),
+    logged_in_user: schemas.UserPrincipal = Depends(get_current_user_by_token),
+    db: AsyncSession = Depends(get_async_db),
+):
+    user = await crud.get_user_with_todos(db, id, todos_limit=todos_limit)
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="User not found"
+        )
+    response = schemas.UserReadNested.model_validate(user)
+    response.todos_next_cursor = next_cursor(user.todos, todos_limit)
+    return response
+
+
+# todo counts of a user, a primary key lookup of the counters maintained by
+# app/stats.py
+@router.get("/{id}/todos/stats", response_model=schemas.TodoStats)
+async def read_user_todo_stats(
+    id: int,
+    logged_in_user: schemas.UserPrincipal = Depends(get_current_user_by_token),
+    db: AsyncSession = Depends(get_async_db),
+):
+    stats = await crud.get_user_todo_stats(db, id)
+    if not stats["total"] and not await crud.get_user(db, id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="User not found"
+        )
+    return stats
+
+
+# stream all todos of a user as ndjson (one TodoRead json per line) or csv
+@router.get("/{id}/todos/export", response_class=StreamingResponse)
+async def export_user_todos(
+    id: int,
+    format: Literal["ndjson", "csv"] = "ndjson",
+    logged_in_user: schemas.UserPrincipal = Depends(get_current_user_by_token),
+    db: AsyncSession = Depends(get_async_db),
+):
+    if not await crud.get_user(db, id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="User not found"
+        )
+    return StreamingResponse(
+        export.export_user_todos_async(id, format),
+        media_type=export.MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="todos-{id}.{format}"'},
+    )
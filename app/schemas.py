@@ -5,7 +5,7 @@
 from datetime import datetime
 
 from fastapi.security.oauth2 import OAuth2PasswordBearer
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, TypeAdapter
 
 from config import Config
 
@@ -19,6 +19,46 @@ class HealthInfo(BaseModel):
     version: str
 
 
+class PoolWaitTime(BaseModel):
+    # cumulative counts keyed by bucket upper bound in seconds
+    buckets: dict[str, int]
+    sum: float
+    count: int
+
+
+class PoolInfo(BaseModel):
+    pool_size: int
+    checked_out: int
+    checked_in: int
+    overflow: int
+    checkouts: int
+    overflow_checkouts: int
+    timeouts: int
+    wait_time_seconds: PoolWaitTime
+
+
+class PoolHealthInfo(BaseModel):
+    engine: PoolInfo
+    # only present when async db mode is enabled
+    async_engine: PoolInfo | None = None
+    # in the order of SQLALCHEMY_REPLICA_URIS
+    replica_engines: list[PoolInfo] = []
+    # only present when async db mode is enabled
+    async_replica_engines: list[PoolInfo] = []
+
+
+class CacheInfo(BaseModel):
+    size: int
+    hits: int
+    misses: int
+
+
+class CachesHealthInfo(BaseModel):
+    auth: CacheInfo
+    principal: CacheInfo
+    session_user: CacheInfo
+
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -45,6 +85,12 @@ class UserRead(UserBase):
         from_attributes = True
 
 
+# identity of the token authenticated user, cached across requests in place
+# of the orm object, which is bound to the session of one request
+class UserPrincipal(UserRead):
+    id: int
+
+
 ## Todo schemas
 
 
@@ -76,5 +122,73 @@ class TodoReadNested(TodoRead):
     owner: UserRead
 
 
+# todos are bounded to the first page, the next pages can be fetched from the
+# todos list endpoint with user_id and todos_next_cursor
 class UserReadNested(UserRead):
     todos: list[TodoRead]
+    todos_next_cursor: str | None = None
+
+
+## batch schemas
+
+
+# result of one item of a batch request, status is the http status code the
+# item would have had as a single request
+class TodoBatchResult(BaseModel):
+    id: int | None
+    status: int
+    detail: str | None = None
+    todo: TodoRead | None = None
+
+
+# a changed or deleted todo of GET /todos/changes
+class TodoChange(BaseModel):
+    id: int
+    version: int
+    deleted: bool
+    # None for deleted todos
+    todo: TodoRead | None = None
+
+
+# a page of changes since a sync version, oldest first
+class TodoChanges(BaseModel):
+    changes: list[TodoChange]
+    # the version to ask the next changes since
+    since: int
+    has_more: bool
+
+
+# todo counts of a user, or of all users
+class TodoStats(BaseModel):
+    total: int
+    completed: int
+    open: int
+
+
+# summary of a bulk import, errors lists the first invalid rows
+class TodoImportResult(BaseModel):
+    imported: int
+    failed: int
+    errors: list[str]
+    seconds: float
+    rows_per_second: int
+
+
+## keyset pagination schemas
+# next_cursor is None when there are no more pages
+
+
+class TodoPage(BaseModel):
+    items: list[TodoRead]
+    next_cursor: str | None
+
+
+class UserPage(BaseModel):
+    items: list[UserRead]
+    next_cursor: str | None
+
+
+# adapters for serializing orm rows of list responses outside of the
+# response_model path, eg. for cached responses
+TodoReadList = TypeAdapter(list[TodoRead])
+UserReadList = TypeAdapter(list[UserRead])
@@ -0,0 +1,111 @@
+# full-text search over todo text
+#
+# - sqlite: an fts5 external content table `todos_fts` indexing todos.text,
+#   kept up to date by triggers on insert, update and delete of todos, and
+#   ranked with bm25()
+# - postgresql: a gin index on the english tsvector of todos.text, which
+#   postgres maintains itself, ranked with ts_rank()
+#
+# the index is updated incrementally in the same transaction as every write
+# to todos, including the batch and bulk paths, not only crud.create_todo etc.
+#
+# both dialects match todos containing all words of the search text, with
+# english stemming, and expose a search `score` where lower is better, so
+# that results are ordered by (score, id) and paginated by keyset on it.
+
+from sqlalchemy import DDL, column, event, func, literal_column, select, table
+from sqlalchemy.engine import Connection
+
+from app import get_logger
+from app.models import Todo
+
+logger = get_logger(__name__)
+
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS todos_fts "
+    "USING fts5(text, content='todos', content_rowid='id', "
+    "tokenize='porter unicode61')",
+    "CREATE TRIGGER IF NOT EXISTS todos_fts_insert AFTER INSERT ON todos BEGIN "
+    "INSERT INTO todos_fts (rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER IF NOT EXISTS todos_fts_delete AFTER DELETE ON todos BEGIN "
+    "INSERT INTO todos_fts (todos_fts, rowid, text) "
+    "VALUES ('delete', old.id, old.text); END",
+    "CREATE TRIGGER IF NOT EXISTS todos_fts_update AFTER UPDATE OF text ON todos "
+    "BEGIN "
+    "INSERT INTO todos_fts (todos_fts, rowid, text) "
+    "VALUES ('delete', old.id, old.text); "
+    "INSERT INTO todos_fts (rowid, text) VALUES (new.id, new.text); END",
+]
+
+# the query must use the same expression as the index, with inline literals,
+# for postgres to match it
+PG_TSVECTOR = "to_tsvector('english', coalesce(todos.text, ''))"
+PG_DDL = [
+    "CREATE INDEX IF NOT EXISTS ix_todos_text_search ON todos "
+    "USING gin (to_tsvector('english', coalesce(text, '')))",
+]
+
+todos_fts = table("todos_fts", column("rowid"), column("text"))
+
+
+# create the search index of an existing todos table, returns False for
+# unsupported dialects
+def create_search_index(conn: Connection) -> bool:
+    dialect = conn.dialect.name
+    if dialect == "sqlite":
+        exists = conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE name = 'todos_fts'"
+        ).first()
+        for statement in SQLITE_DDL:
+            conn.exec_driver_sql(statement)
+        # index the todos inserted before the fts table existed
+        if not exists:
+            logger.info(">> rebuilding todos full-text search index")
+            conn.exec_driver_sql("INSERT INTO todos_fts (todos_fts) VALUES ('rebuild')")
+    elif dialect == "postgresql":
+        for statement in PG_DDL:
+            conn.exec_driver_sql(statement)
+    else:
+        logger.warning(f"full-text search is not supported on {dialect}")
+        return False
+    return True
+
+
+@event.listens_for(Todo.__table__, "after_create")
+def _after_create(target, connection, **kw):
+    create_search_index(connection)
+
+
+# triggers are dropped with the todos table, the fts table is not
+event.listen(
+    Todo.__table__,
+    "before_drop",
+    DDL("DROP TABLE IF EXISTS todos_fts").execute_if(dialect="sqlite"),
+)
+
+
+# match each word of the search text as is, fts5 query syntax errors on
+# input like unbalanced quotes or a leading `-`
+def sqlite_match_query(text: str) -> str:
+    return " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+
+# (select, score) of the todos matching all words of `text` with their search
+# score, for the given dialect. the select is left to be filtered, ordered and
+# limited by the caller
+def search_todos_select(dialect: str, text: str):
+    if dialect == "sqlite":
+        score = func.bm25(literal_column("todos_fts"))
+        stmt = (
+            select(Todo, score.label("score"))
+            .join(todos_fts, todos_fts.c.rowid == Todo.id)
+            .where(literal_column("todos_fts").match(sqlite_match_query(text)))
+        )
+        return stmt, score
+    if dialect == "postgresql":
+        tsvector = literal_column(PG_TSVECTOR)
+        tsquery = func.plainto_tsquery(literal_column("'english'"), text)
+        score = -func.ts_rank(tsvector, tsquery)
+        stmt = select(Todo, score.label("score")).where(tsvector.op("@@")(tsquery))
+        return stmt, score
+    raise NotImplementedError(f"full-text search is not supported on {dialect}")
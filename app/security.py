@@ -1,36 +1,158 @@
+import asyncio
+import functools
+import hashlib
+import hmac
 import logging
+import secrets
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
 
-from passlib.context import CryptContext
+from sqlalchemy import event, inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from jose import jwt
-
+from starlette.concurrency import run_in_threadpool
 
 from config import Config
 
+from app.cache import TTLCache
+from app.metrics import password_hash_pending_jobs, password_hash_seconds
 from app.models import User
 
 logging.basicConfig(level=Config.LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# passlib and jose are imported on first use, out of the worker start up,
+# together they take about a tenth of the app import time
+
+
+@functools.cache
+def get_pwd_context():
+    from passlib.context import CryptContext
+
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+# bcrypt is cpu bound by design (~250ms per hash), and releases the GIL, so
+# it runs on a dedicated bounded thread pool instead of blocking the event
+# loop or holding a starlette thread pool worker
+class PasswordHashingBusy(Exception):
+    """too many pending password hash jobs, the request should be retried"""
+
+
+password_hash_executor = ThreadPoolExecutor(
+    max_workers=Config.PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash"
+)
+password_hash_slots = threading.BoundedSemaphore(Config.PASSWORD_HASH_MAX_PENDING)
+
+
+def submit_password_hash_job(func, *args) -> Future:
+    # reject instead of queueing, so a login burst can't grow latency unbounded
+    if not password_hash_slots.acquire(blocking=False):
+        raise PasswordHashingBusy()
+    password_hash_pending_jobs.inc()
+    future = password_hash_executor.submit(func, *args)
+    future.add_done_callback(password_hash_job_done)
+    return future
+
 
+def password_hash_job_done(future: Future) -> None:
+    password_hash_pending_jobs.dec()
+    password_hash_slots.release()
 
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
 
+def hash_password_job(password: str) -> str:
+    with password_hash_seconds.labels("hash").time():
+        return get_pwd_context().hash(password)
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
 
+def verify_password_job(plain_password: str, hashed_password: str) -> bool:
+    with password_hash_seconds.labels("verify").time():
+        return get_pwd_context().verify(plain_password, hashed_password)
+
+
+# cache of successful verifications, keyed by a hmac with a per-process random
+# key, so neither plain passwords nor fast unsalted hashes of them are kept
+auth_cache = TTLCache(maxsize=1024, ttl=Config.AUTH_CACHE_TTL)
+auth_cache_key = secrets.token_bytes(32)
+
+
+def get_auth_cache_key(plain_password: str, hashed_password: str) -> bytes:
+    message = f"{hashed_password}:{plain_password}".encode()
+    return hmac.new(auth_cache_key, message, hashlib.sha256).digest()
+
+
+# cache of token authenticated users (schemas.UserPrincipal) by token subject
+# (email), entries are invalidated when the user row changes in this worker,
+# and expire after PRINCIPAL_CACHE_TTL in other workers
+principal_cache = TTLCache(maxsize=4096, ttl=Config.PRINCIPAL_CACHE_TTL)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def invalidate_principal(mapper, connection, user: User):
+    principal_cache.delete(user.email)
+    # the email itself may have changed
+    for email in inspect(user).attrs.email.history.deleted or []:
+        principal_cache.delete(email)
+
+
+async def get_password_hash_async(password: str) -> str:
+    return await asyncio.wrap_future(
+        submit_password_hash_job(hash_password_job, password)
+    )
 
-def authenticate_user(db: Session, email: str, password: str):
+
+async def verify_password_async(plain_password, hashed_password):
+    cache_key = get_auth_cache_key(plain_password, hashed_password)
+    if auth_cache.get(cache_key):
+        return True
+    verified = await asyncio.wrap_future(
+        submit_password_hash_job(verify_password_job, plain_password, hashed_password)
+    )
+    if verified:
+        auth_cache.set(cache_key, True)
+    return verified
+
+
+# end the transaction of the user lookup before the password is verified, so
+# the logins waiting on the password hash pool don't hold db connections, and
+# exhaust the db pool. the user is detached and keeps its loaded attributes
+def release_user(db: Session, user: User) -> None:
+    db.expunge(user)
+    db.rollback()
+
+
+def get_login_user(db: Session, email: str) -> User | None:
     user = db.query(User).filter(User.email == email).first()
     logger.info(f">> authenticate user: {user}")
+    if user:
+        release_user(db, user)
+    return user
+
+
+# with the sync session, the user lookup runs on the starlette thread pool and
+# the verification is awaited, so no thread waits on the password hash pool
+async def authenticate_user(db: Session, email: str, password: str):
+    user = await run_in_threadpool(get_login_user, db, email)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await verify_password_async(password, user.hashed_password):
+        return False
+    return user
+
+
+async def authenticate_user_async(db: AsyncSession, email: str, password: str):
+    user = (
+        (await db.execute(select(User).filter(User.email == email))).scalars().first()
+    )
+    logger.info(f">> authenticate user: {user}")
+    if not user:
+        return False
+    db.expunge(user)
+    await db.rollback()
+    if not await verify_password_async(password, user.hashed_password):
         return False
     return user
 
@@ -48,12 +170,18 @@ ACCESS_TOKEN_EXPIRE_MINUTES = Config.ACCESS_TOKEN_EXPIRE_MINUTES
 SECRET_KEY = Config.SECRET_KEY
 
 
+class InvalidToken(Exception):
+    """the token can't be decoded, or its signature or claims are invalid"""
+
+
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
     if not expires_delta:
         expires_delta = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     expire = datetime.utcnow() + expires_delta
     to_encode.update({"exp": expire})
+    from jose import jwt
+
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
@@ -66,10 +194,19 @@ def decode_access_token(token: str, audience: str = None, options: dict = {}):
         options: dict
             varify_aud: enable or disable aud (audience) verification
     Raises:
-        all Exceptions from jwt.decode() method
+        InvalidToken, for the JWTError of jwt.decode() method
     """
-    payload = jwt.decode(
-        token, SECRET_KEY, algorithms=[ALGORITHM], audience=audience, options=options
-    )
+    from jose import JWTError, jwt
+
+    try:
+        payload = jwt.decode(
+            token,
+            SECRET_KEY,
+            algorithms=[ALGORITHM],
+            audience=audience,
+            options=options,
+        )
+    except JWTError as e:
+        raise InvalidToken(str(e)) from e
     # payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM], audience=audience, options={"varify_aud": False})
     return payload
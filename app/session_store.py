@@ -0,0 +1,100 @@
+# server-side web session store backed by a local sqlite file
+#
+# the session cookie only carries a random session id, instead of the whole
+# signed session data as with starsessions CookieStore. the sqlite file is
+# shared by the worker processes of one host (or pod), put it on a tmpfs
+# volume (eg. /tmp in k8s) to keep it in memory.
+#
+# sessions are not shared across hosts, so multi-replica deployments need
+# sticky sessions or the cookie store.
+
+import json
+import sqlite3
+import threading
+import time
+
+from starlette.concurrency import run_in_threadpool
+from starsessions import SessionStore
+
+from app.cache import TTLCache
+
+# session-only cookies (lifetime 0) have no expiry, keep their data this long
+SESSION_GC_TTL = 3600 * 24 * 30
+
+
+class SQLiteSessionStore(SessionStore):
+    def __init__(self, path: str, gc_interval: int = 100):
+        self.path = path
+        self.gc_interval = gc_interval
+        self._writes = 0
+        self._local = threading.local()
+        # session content as last read by this worker, to skip writing
+        # sessions back when only the last_access metadata has changed
+        self._read_content = TTLCache(maxsize=4096, ttl=SESSION_GC_TTL)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id TEXT PRIMARY KEY, data BLOB NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    # one connection per thread, sqlite connections can't be shared by threads
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # session data without the last_access timestamp, which starsessions
+    # updates on every request
+    @staticmethod
+    def _content(data: bytes) -> str:
+        payload = json.loads(data or b"{}")
+        payload.get("__metadata__", {}).pop("last_access", None)
+        return json.dumps(payload, sort_keys=True)
+
+    def _read(self, session_id: str) -> bytes:
+        row = (
+            self._connect()
+            .execute(
+                "SELECT data FROM sessions WHERE id = ? AND expires_at > ?",
+                (session_id, time.time()),
+            )
+            .fetchone()
+        )
+        return row[0] if row else b""
+
+    def _write(self, session_id: str, data: bytes, ttl: int) -> None:
+        conn = self._connect()
+        conn.execute(
+            "INSERT INTO sessions (id, data, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET "
+            "data = excluded.data, expires_at = excluded.expires_at",
+            (session_id, data, time.time() + ttl),
+        )
+        self._writes += 1
+        if self._writes % self.gc_interval == 0:
+            conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),))
+
+    def _remove(self, session_id: str) -> None:
+        self._connect().execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    async def read(self, session_id: str, lifetime: int) -> bytes:
+        data = await run_in_threadpool(self._read, session_id)
+        self._read_content.set(session_id, self._content(data))
+        return data
+
+    async def write(self, session_id: str, data: bytes, lifetime: int, ttl: int) -> str:
+        if self._read_content.get(session_id) == self._content(data):
+            return session_id
+        if lifetime == 0:
+            ttl = SESSION_GC_TTL
+        await run_in_threadpool(self._write, session_id, data, max(1, ttl))
+        self._read_content.delete(session_id)
+        return session_id
+
+    async def remove(self, session_id: str) -> None:
+        self._read_content.delete(session_id)
+        await run_in_threadpool(self._remove, session_id)
@@ -0,0 +1,103 @@
+# opt-in sql profiling, in place of logging every statement with echo=True
+#
+# - per request profile: with Config.SQL_PROFILING enabled, requests with a
+#   `X-Debug-SQL: 1` header or a `debug_sql=1` query parameter get the time of
+#   their db statements in a `Server-Timing` response header, shown by the
+#   browser dev tools network panel
+# - slow query log: statements slower than Config.SLOW_QUERY_MS are logged
+#   with their duration, whether the request is profiled or not
+#
+# the engine event hooks are only registered when one of them is enabled, so
+# there is no overhead when both are off.
+
+import time
+from contextvars import ContextVar
+from urllib.parse import parse_qs
+
+from sqlalchemy import Engine, event
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from config import Config
+
+from app import get_logger
+
+logger = get_logger(__name__)
+
+DEBUG_HEADER = b"x-debug-sql"
+DEBUG_PARAM = "debug_sql"
+# statements listed one by one in Server-Timing, the total covers all of them
+MAX_TIMING_ENTRIES = 20
+MAX_DESCRIPTION_LENGTH = 80
+
+# (statement, seconds) of the current profiled request, a mutable list shared
+# with the sync routes running in a copy of the request context
+request_statements: ContextVar[list[tuple[str, float]] | None] = ContextVar(
+    "request_statements", default=None
+)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._profiling_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - context._profiling_started
+    statements = request_statements.get()
+    if statements is not None:
+        statements.append((statement, seconds))
+    if Config.SLOW_QUERY_MS and seconds * 1000 >= Config.SLOW_QUERY_MS:
+        logger.warning(
+            f"slow query ({seconds * 1000:.1f}ms): {' '.join(statement.split())}"
+        )
+
+
+def instrument_engine(engine: Engine) -> None:
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+def is_debug_request(scope: Scope) -> bool:
+    for name, value in scope["headers"]:
+        if name == DEBUG_HEADER:
+            return value == b"1"
+    query = parse_qs(scope.get("query_string", b"").decode())
+    return query.get(DEBUG_PARAM) == ["1"]
+
+
+# Server-Timing header value, eg.
+# db;dur=1.52;desc="3 statements", sql-1;dur=0.61;desc="SELECT todos.id ..."
+def server_timing(statements: list[tuple[str, float]]) -> str:
+    total = sum(seconds for _, seconds in statements)
+    entries = [f'db;dur={total * 1000:.2f};desc="{len(statements)} statements"']
+    for i, (statement, seconds) in enumerate(statements[:MAX_TIMING_ENTRIES], 1):
+        # quoted-string description, on one line
+        description = " ".join(statement.split())[:MAX_DESCRIPTION_LENGTH]
+        description = description.replace("\\", "").replace('"', "'")
+        entries.append(f'sql-{i};dur={seconds * 1000:.2f};desc="{description}"')
+    return ", ".join(entries)
+
+
+# pure asgi middleware, profiles the requests asking for it
+class SQLProfilingMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not is_debug_request(scope):
+            return await self.app(scope, receive, send)
+
+        statements = []
+
+        async def send_wrapper(message: Message) -> None:
+            # statements run while streaming the body are not included
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", server_timing(statements))
+            await send(message)
+
+        token = request_statements.set(statements)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_statements.reset(token)
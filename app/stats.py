@@ -0,0 +1,150 @@
+# todo counts per owner, total and completed, in the todo_counts table
+#
+# the counts are maintained by triggers on todos, in the same transaction as
+# every insert, delete and update of completed or owner_id, including the
+# batch, bulk import and seed paths, so reading the stats of a user is a
+# primary key lookup instead of a COUNT(*) over its todos. the global stats
+# sum the per owner rows.
+#
+# reconcile_todo_counts() recomputes the counts from todos and repairs the
+# rows that drifted, eg. after writes with the triggers disabled. it runs
+# periodically with `python -m app.stats`, eg. from cron, and on UPDATE_DB
+# only to backfill the counts of an existing todos table, when its triggers
+# are created, not on every worker start up. it doesn't lock todos, writes
+# committed during a reconciliation may be off until the next one.
+
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Connection
+
+from config import Config
+
+from app import get_logger
+from app.cache import TTLCache
+from app.models import Base
+
+logger = get_logger(__name__)
+
+# the global stats sum a row per owner, they are cached for STATS_CACHE_TTL
+stats_cache = TTLCache(maxsize=1, ttl=Config.STATS_CACHE_TTL)
+
+SQLITE_DDL = [
+    "CREATE TRIGGER IF NOT EXISTS todo_counts_insert AFTER INSERT ON todos "
+    "WHEN new.owner_id IS NOT NULL BEGIN "
+    "INSERT INTO todo_counts (owner_id, total, completed) "
+    "VALUES (new.owner_id, 1, coalesce(new.completed, 0)) "
+    "ON CONFLICT (owner_id) DO UPDATE SET total = total + 1, "
+    "completed = completed + excluded.completed; END",
+    "CREATE TRIGGER IF NOT EXISTS todo_counts_delete AFTER DELETE ON todos "
+    "WHEN old.owner_id IS NOT NULL BEGIN "
+    "UPDATE todo_counts SET total = total - 1, "
+    "completed = completed - coalesce(old.completed, 0) "
+    "WHERE owner_id = old.owner_id; END",
+    "CREATE TRIGGER IF NOT EXISTS todo_counts_update "
+    "AFTER UPDATE OF completed, owner_id ON todos BEGIN "
+    "UPDATE todo_counts SET total = total - 1, "
+    "completed = completed - coalesce(old.completed, 0) "
+    "WHERE owner_id = old.owner_id; "
+    "INSERT INTO todo_counts (owner_id, total, completed) "
+    "SELECT new.owner_id, 1, coalesce(new.completed, 0) "
+    "WHERE new.owner_id IS NOT NULL "
+    "ON CONFLICT (owner_id) DO UPDATE SET total = total + 1, "
+    "completed = completed + excluded.completed; END",
+]
+
+PG_DDL = [
+    """
+    CREATE OR REPLACE FUNCTION todo_counts_update() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.owner_id IS NOT NULL THEN
+            UPDATE todo_counts SET total = total - 1,
+                completed = completed - coalesce(OLD.completed, false)::int
+            WHERE owner_id = OLD.owner_id;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.owner_id IS NOT NULL THEN
+            INSERT INTO todo_counts (owner_id, total, completed)
+            VALUES (NEW.owner_id, 1, coalesce(NEW.completed, false)::int)
+            ON CONFLICT (owner_id) DO UPDATE
+            SET total = todo_counts.total + 1,
+                completed = todo_counts.completed + excluded.completed;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS todo_counts ON todos",
+    "CREATE TRIGGER todo_counts "
+    "AFTER INSERT OR DELETE OR UPDATE OF completed, owner_id ON todos "
+    "FOR EACH ROW EXECUTE FUNCTION todo_counts_update()",
+]
+
+# upsert the actual counts of the owners whose row is missing or differs
+RECONCILE_UPSERT = (
+    "INSERT INTO todo_counts (owner_id, total, completed) "
+    "SELECT owner_id, count(*), sum(CASE WHEN completed THEN 1 ELSE 0 END) "
+    "FROM todos WHERE owner_id IS NOT NULL GROUP BY owner_id "
+    "ON CONFLICT (owner_id) DO UPDATE "
+    "SET total = excluded.total, completed = excluded.completed "
+    "WHERE todo_counts.total <> excluded.total "
+    "OR todo_counts.completed <> excluded.completed"
+)
+# remove the rows of owners without todos
+RECONCILE_DELETE = (
+    "DELETE FROM todo_counts WHERE NOT EXISTS "
+    "(SELECT 1 FROM todos WHERE todos.owner_id = todo_counts.owner_id)"
+)
+
+
+def stats_triggers_exist(conn: Connection) -> bool:
+    if conn.dialect.name == "sqlite":
+        query = (
+            "SELECT 1 FROM sqlite_master "
+            "WHERE type = 'trigger' AND name = 'todo_counts_insert'"
+        )
+    elif conn.dialect.name == "postgresql":
+        query = "SELECT 1 FROM pg_trigger WHERE tgname = 'todo_counts'"
+    else:
+        return False
+    return conn.exec_driver_sql(query).first() is not None
+
+
+# create the count triggers of an existing todos table, returns False for
+# unsupported dialects
+def create_stats_triggers(conn: Connection) -> bool:
+    dialect = conn.dialect.name
+    if dialect == "sqlite":
+        statements = SQLITE_DDL
+    elif dialect == "postgresql":
+        statements = PG_DDL
+    else:
+        logger.warning(f"todo count triggers are not supported on {dialect}")
+        return False
+    for statement in statements:
+        conn.exec_driver_sql(statement)
+    return True
+
+
+# after all the tables are created, the triggers of todos use todo_counts
+@event.listens_for(Base.metadata, "after_create")
+def _after_create(target, connection, **kw):
+    create_stats_triggers(connection)
+
+
+# returns the number of repaired rows
+def reconcile_todo_counts(conn: Connection) -> int:
+    started = time.perf_counter()
+    repaired = conn.exec_driver_sql(RECONCILE_UPSERT).rowcount
+    repaired += conn.exec_driver_sql(RECONCILE_DELETE).rowcount
+    logger.info(
+        f">> reconciled todo counts, {repaired} rows repaired "
+        f"in {time.perf_counter() - started:.2f}s"
+    )
+    return repaired
+
+
+if __name__ == "__main__":
+    from app.db import engine
+
+    with engine.begin() as conn:
+        print(f"{reconcile_todo_counts(conn)} rows repaired")
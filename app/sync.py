@@ -0,0 +1,183 @@
+# change versions and tombstones of todos, for the incremental sync of
+# GET /todos/changes
+#
+# every todo change bumps the version of its owner in todo_versions and
+# stamps the todo with it, a deleted todo, or one moved to another owner,
+# leaves a tombstone with the version of the owner it was removed from. a
+# client keeps the last version it has seen and asks for the changes since,
+# which are the todos and tombstones of the owner with a higher version, in
+# O(changes) through the (owner_id, version) indexes.
+#
+# the versions are set by triggers on todos, in the same transaction as every
+# insert, delete and update of text, completed or owner_id, including the
+# batch, bulk import and seed paths. the todo_versions row of the owner is
+# locked by the bump until the transaction ends, so the versions of an owner
+# are committed in order, and a client never skips the change of a slower
+# concurrent transaction.
+#
+# tombstones older than Config.SYNC_TOMBSTONE_DAYS are pruned periodically
+# with `python -m app.sync`, eg. from cron. clients with a version older than
+# the pruned tombstones of their owner can't tell what was deleted, they get
+# 410 and sync again from version 0.
+
+import argparse
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, inspect, text
+from sqlalchemy.engine import Connection
+
+from config import Config
+
+from app import get_logger
+from app.models import Base
+
+logger = get_logger(__name__)
+
+# sqlite can't set new.version in a before trigger, the after triggers
+# update the row instead. the update of version alone fires no trigger
+SQLITE_BUMP = (
+    "INSERT INTO todo_versions (owner_id, version, pruned_version) "
+    "SELECT {owner}.owner_id, 1, 0 WHERE {owner}.owner_id IS NOT NULL{where} "
+    "ON CONFLICT (owner_id) DO UPDATE SET version = version + 1; "
+)
+SQLITE_STAMP = (
+    "UPDATE todos SET version = (SELECT version FROM todo_versions "
+    "WHERE owner_id = new.owner_id) WHERE id = new.id; "
+)
+SQLITE_TOMBSTONE = (
+    "INSERT INTO todo_tombstones (owner_id, version, todo_id, deleted_at) "
+    "SELECT owner_id, version, old.id, CURRENT_TIMESTAMP FROM todo_versions "
+    "WHERE owner_id = old.owner_id{where}; "
+)
+MOVED = " AND old.owner_id IS NOT new.owner_id"
+
+SQLITE_DDL = [
+    "CREATE TRIGGER IF NOT EXISTS todo_sync_insert AFTER INSERT ON todos BEGIN "
+    + SQLITE_BUMP.format(owner="new", where="")
+    + SQLITE_STAMP
+    + "END",
+    "CREATE TRIGGER IF NOT EXISTS todo_sync_delete AFTER DELETE ON todos BEGIN "
+    + SQLITE_BUMP.format(owner="old", where="")
+    + SQLITE_TOMBSTONE.format(where="")
+    + "END",
+    "CREATE TRIGGER IF NOT EXISTS todo_sync_update "
+    "AFTER UPDATE OF text, completed, owner_id ON todos BEGIN "
+    + SQLITE_BUMP.format(owner="old", where=MOVED)
+    + SQLITE_TOMBSTONE.format(where=MOVED)
+    + SQLITE_BUMP.format(owner="new", where="")
+    + SQLITE_STAMP
+    + "END",
+]
+
+PG_DDL = [
+    """
+    CREATE OR REPLACE FUNCTION todo_sync_update() RETURNS trigger AS $$
+    DECLARE
+        next_version integer;
+    BEGIN
+        IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE'
+                AND OLD.owner_id IS DISTINCT FROM NEW.owner_id) THEN
+            IF OLD.owner_id IS NOT NULL THEN
+                INSERT INTO todo_versions (owner_id, version, pruned_version)
+                VALUES (OLD.owner_id, 1, 0)
+                ON CONFLICT (owner_id) DO UPDATE
+                SET version = todo_versions.version + 1
+                RETURNING version INTO next_version;
+                INSERT INTO todo_tombstones (owner_id, version, todo_id, deleted_at)
+                VALUES (OLD.owner_id, next_version, OLD.id,
+                    now() AT TIME ZONE 'utc');
+            END IF;
+        END IF;
+        IF TG_OP = 'DELETE' THEN
+            RETURN OLD;
+        END IF;
+        NEW.version := NULL;
+        IF NEW.owner_id IS NOT NULL THEN
+            INSERT INTO todo_versions (owner_id, version, pruned_version)
+            VALUES (NEW.owner_id, 1, 0)
+            ON CONFLICT (owner_id) DO UPDATE
+            SET version = todo_versions.version + 1
+            RETURNING version INTO next_version;
+            NEW.version := next_version;
+        END IF;
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS todo_sync ON todos",
+    "CREATE TRIGGER todo_sync "
+    "BEFORE INSERT OR DELETE OR UPDATE OF text, completed, owner_id ON todos "
+    "FOR EACH ROW EXECUTE FUNCTION todo_sync_update()",
+]
+
+
+# create the version triggers of an existing todos table, returns False for
+# unsupported dialects
+def create_sync_triggers(conn: Connection) -> bool:
+    dialect = conn.dialect.name
+    if dialect == "sqlite":
+        statements = SQLITE_DDL
+    elif dialect == "postgresql":
+        statements = PG_DDL
+    else:
+        logger.warning(f"todo sync triggers are not supported on {dialect}")
+        return False
+    for statement in statements:
+        conn.exec_driver_sql(statement)
+    return True
+
+
+# after all the tables are created, the triggers of todos use todo_versions
+# and todo_tombstones
+@event.listens_for(Base.metadata, "after_create")
+def _after_create(target, connection, **kw):
+    create_sync_triggers(connection)
+
+
+# add the version column to a todos table created without it, the existing
+# todos get their id as version, which is unique and ordered per owner, before
+# the triggers and the index are created
+def add_version_column(conn: Connection) -> None:
+    columns = {column["name"] for column in inspect(conn).get_columns("todos")}
+    if "version" in columns:
+        return
+    logger.info(">> adding todos.version, backfilling the versions")
+    conn.exec_driver_sql("ALTER TABLE todos ADD COLUMN version INTEGER")
+    conn.exec_driver_sql("UPDATE todos SET version = id")
+    conn.exec_driver_sql(
+        "INSERT INTO todo_versions (owner_id, version, pruned_version) "
+        "SELECT owner_id, max(version), 0 FROM todos "
+        "WHERE owner_id IS NOT NULL GROUP BY owner_id "
+        "ON CONFLICT (owner_id) DO UPDATE SET version = excluded.version"
+    )
+
+
+# delete the tombstones older than `days`, and record the highest pruned
+# version of each owner, returns the number of deleted tombstones
+def prune_tombstones(conn: Connection, days: float) -> int:
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    pruned = "t.owner_id = todo_versions.owner_id AND t.deleted_at < :cutoff"
+    conn.execute(
+        text(
+            "UPDATE todo_versions SET pruned_version = (SELECT max(t.version) "
+            f"FROM todo_tombstones t WHERE {pruned}) WHERE EXISTS "
+            f"(SELECT 1 FROM todo_tombstones t WHERE {pruned})"
+        ),
+        {"cutoff": cutoff},
+    )
+    deleted = conn.execute(
+        text("DELETE FROM todo_tombstones WHERE deleted_at < :cutoff"),
+        {"cutoff": cutoff},
+    ).rowcount
+    logger.info(f">> pruned {deleted} todo tombstones older than {days} days")
+    return deleted
+
+
+if __name__ == "__main__":
+    from app.db import engine
+
+    parser = argparse.ArgumentParser(description="prune todo tombstones")
+    parser.add_argument("--days", type=float, default=Config.SYNC_TOMBSTONE_DAYS)
+    args = parser.parse_args()
+    with engine.begin() as conn:
+        print(f"{prune_tombstones(conn, args.days)} tombstones pruned")
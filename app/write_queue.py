@@ -0,0 +1,147 @@
+# single-writer queue of the sqlite todo writes of a worker process, with
+# group commit, enabled by Config.SQLITE_WRITE_QUEUE
+#
+# sqlite has one writer at a time. concurrent write requests on the thread
+# pool contend for the write lock, wait on busy_timeout and commit one by one.
+# with the queue, the todo write routes submit their crud function instead,
+# and one writer thread runs the queued writes one after another in a shared
+# transaction:
+# - each write runs in its own session, joined to the shared transaction with
+#   a savepoint, the commit() of the crud function releases the savepoint, and
+#   a failing write only rolls back its savepoint
+# - the transaction of up to Config.SQLITE_WRITE_BATCH writes is committed
+#   once, and the results are returned after that commit
+# - BEGIN IMMEDIATE takes the write lock up front, waiting on busy_timeout for
+#   the writers of the other worker processes
+#
+# results are detached orm objects with their columns loaded by the crud
+# functions, or core rows. the todo events published by the writes are
+# published after the group commit, see app/events.py
+
+import asyncio
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable
+
+from sqlalchemy import Engine, create_engine, event
+from sqlalchemy.orm import Session
+
+from config import Config
+
+from app import get_logger
+from app.db import SQLALCHEMY_DATABASE_URI, SQLITE_TUNED, set_sqlite_pragmas
+from app.events import event_bus
+
+logger = get_logger(__name__)
+
+
+def create_writer_engine() -> Engine:
+    engine = create_engine(
+        SQLALCHEMY_DATABASE_URI,
+        connect_args={"check_same_thread": False},
+        pool_size=1,
+        max_overflow=0,
+        echo=Config.SQLALCHEMY_ECHO,
+    )
+
+    # the pysqlite driver begins transactions itself, only before dml, which
+    # breaks savepoints, sqlalchemy emits BEGIN IMMEDIATE instead
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        if SQLITE_TUNED:
+            set_sqlite_pragmas(dbapi_connection, connection_record)
+
+    @event.listens_for(engine, "begin")
+    def begin(conn):
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+    return engine
+
+
+class WriteQueue:
+    def __init__(self, engine: Engine, max_batch: int):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.jobs = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    # run `func(db, *args)` on the writer thread
+    def submit(self, func: Callable, *args) -> Future:
+        future = Future()
+        self.jobs.put((future, func, args))
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name="sqlite-writer", daemon=True
+                    )
+                    self._thread.start()
+        return future
+
+    def run(self, func: Callable, *args):
+        return self.submit(func, *args).result()
+
+    async def run_async(self, func: Callable, *args):
+        return await asyncio.wrap_future(self.submit(func, *args))
+
+    def _run(self) -> None:
+        while True:
+            batch = [self.jobs.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+            # skip the writes of cancelled requests
+            batch = [job for job in batch if job[0].set_running_or_notify_cancel()]
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch: list) -> None:
+        outcomes = []
+        published = []
+        try:
+            with self.engine.connect() as conn, conn.begin():
+                for future, func, args in batch:
+                    try:
+                        with (
+                            event_bus.deferred() as events,
+                            Session(
+                                bind=conn, join_transaction_mode="create_savepoint"
+                            ) as db,
+                        ):
+                            outcomes.append((future, func(db, *args), None))
+                    except Exception as e:
+                        outcomes.append((future, None, e))
+                    else:
+                        published.extend(events)
+        # the begin or the group commit failed, all the writes did
+        except Exception as e:
+            logger.exception(f"group commit of {len(batch)} writes failed")
+            for future, _, _ in batch:
+                future.set_exception(e)
+            return
+        for change in published:
+            event_bus.publish(*change)
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+if Config.SQLITE_WRITE_QUEUE and SQLALCHEMY_DATABASE_URI.startswith("sqlite:"):
+    write_queue = WriteQueue(create_writer_engine(), Config.SQLITE_WRITE_BATCH)
+else:
+    write_queue = None
+
+
+# run the crud write function `func(db, *args)` on the write queue if enabled,
+# or with the request session
+def run_write(db: Session, func: Callable, *args):
+    if write_queue is None:
+        return func(db, *args)
+    return write_queue.run(func, *args)
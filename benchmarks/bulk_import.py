@@ -0,0 +1,81 @@
+# rows/sec benchmark of todo ingestion on a temporary sqlite file db:
+#
+# - create_todo: crud.create_todo per row, with its insert, commit and refresh
+# - bulk_import: app/bulk_import.py on an ndjson stream, with several chunk
+#   sizes (executemany on sqlite, COPY on postgresql)
+#
+# run from the project root with `python -m benchmarks.bulk_import`
+
+import json
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import Session
+
+from app import bulk_import, crud, schemas
+from app.models import Base, User
+
+CREATE_TODO_ROWS = 1000
+IMPORT_ROWS = 100_000
+CHUNK_SIZES = (500, 5000, 20000)
+
+
+def ndjson_lines(count: int):
+    for i in range(count):
+        yield json.dumps({"text": f"imported todo {i}", "completed": i % 2 == 0})
+
+
+def setup_db(path: str):
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        owner_id = conn.execute(
+            insert(User).returning(User.id),
+            {"email": "bench@example.com", "hashed_password": "x"},
+        ).scalar_one()
+    return engine, owner_id
+
+
+def bench_create_todo(engine, owner_id: int) -> float:
+    owner = schemas.UserPrincipal(
+        id=owner_id,
+        email="bench@example.com",
+        created_at=datetime.utcnow(),
+        updated_at=datetime.utcnow(),
+    )
+    started = time.perf_counter()
+    with Session(engine) as db:
+        for line in ndjson_lines(CREATE_TODO_ROWS):
+            crud.create_todo(db, owner, schemas.TodoCreate.model_validate_json(line))
+    return CREATE_TODO_ROWS / (time.perf_counter() - started)
+
+
+def bench_bulk_import(engine, owner_id: int, chunk_size: int) -> float:
+    result = bulk_import.import_todos(
+        engine,
+        bulk_import.parse_ndjson(ndjson_lines(IMPORT_ROWS)),
+        owner_id=owner_id,
+        chunk_size=chunk_size,
+    )
+    assert result.imported == IMPORT_ROWS
+    return result.rows_per_second
+
+
+def run() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        engine, owner_id = setup_db(os.path.join(tmp, "bench.db"))
+        print(f"{'path':<28} {'rows':>8} {'rows/s':>10}")
+        rate = bench_create_todo(engine, owner_id)
+        print(f"{'create_todo':<28} {CREATE_TODO_ROWS:>8} {rate:>10.0f}")
+        for chunk_size in CHUNK_SIZES:
+            rate = bench_bulk_import(engine, owner_id, chunk_size)
+            name = f"bulk_import chunk={chunk_size}"
+            print(f"{name:<28} {IMPORT_ROWS:>8} {rate:>10.0f}")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    run()
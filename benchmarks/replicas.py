@@ -0,0 +1,166 @@
+# check of the read replica routing of app/replicas.py, with two sqlite
+# copies of the primary as replica stand-ins, in sync and async db mode.
+#
+# the engines record the database of each statement, and the check asserts
+# which one served the requests:
+# - GET requests read from the replicas, round-robin
+# - a write runs on the primary, and the next reads of the client stick to the
+#   primary until its read_primary cookie expires
+# - a replica that is down is skipped, the reads fall back to the primary
+#   when both are
+#
+#   python -m benchmarks.replicas
+
+import argparse
+import asyncio
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+import httpx
+
+MODES = {"sync": {"SQLALCHEMY_ASYNC": "0"}, "async": {"SQLALCHEMY_ASYNC": "1"}}
+REPLICAS = ("replica1.db", "replica2.db")
+
+
+def seed(db_dir: str) -> None:
+    from app.db import engine
+    from app.db_migration import seed_data
+    from app.models import Base
+
+    Base.metadata.create_all(engine)
+    seed_data(engine, 2, 10, seed=1)
+    engine.dispose()
+    # a file copy of a WAL database may miss its last commits
+    with sqlite3.connect(os.path.join(db_dir, "primary.db")) as primary:
+        for name in REPLICAS:
+            with sqlite3.connect(os.path.join(db_dir, name)) as replica:
+                primary.backup(replica)
+
+
+async def check() -> list[str]:
+    from sqlalchemy import event
+
+    from app import db
+    from app.main import app
+
+    engines = [db.engine, *db.replica_engines]
+    if db.async_engine is not None:
+        engines = [db.async_engine, *db.async_replica_engines]
+    served = []
+    for engine in engines:
+        engine = getattr(engine, "sync_engine", engine)
+        name = os.path.basename(engine.url.database)
+
+        def record(*args, name=name):
+            served.append(name)
+
+        event.listen(engine, "before_cursor_execute", record)
+
+    async def read(client: httpx.AsyncClient) -> set[str]:
+        served.clear()
+        response = await client.get("/api/v1/todos/1")
+        response.raise_for_status()
+        return set(served)
+
+    failures = []
+
+    def expect(what: str, databases: set[str], expected: set[str]) -> None:
+        if databases != expected:
+            failures.append(f"{what}: served by {databases}, expected {expected}")
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://check"
+    ) as client:
+        response = await client.post(
+            "/auth/token",
+            data={"username": "user0@example.com", "password": "secret"},
+        )
+        response.raise_for_status()
+        headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+        client.cookies.clear()
+
+        expect("first read", await read(client), {REPLICAS[0]})
+        expect("second read", await read(client), {REPLICAS[1]})
+
+        served.clear()
+        todo = {"id": 1, "text": "replica check", "completed": True}
+        response = await client.put("/api/v1/todos/1", json=todo, headers=headers)
+        response.raise_for_status()
+        expect("write", set(served), {"primary.db"})
+        expect("read after the write", await read(client), {"primary.db"})
+
+        # the read_primary cookie expired
+        client.cookies.clear()
+        expect("read after the cookie", await read(client), {REPLICAS[0]})
+
+        db.replicas.set_healthy(db.replica_engines[0], False)
+        expect("one replica down", await read(client), {REPLICAS[1]})
+        db.replicas.set_healthy(db.replica_engines[1], False)
+        expect("both replicas down", await read(client), {"primary.db"})
+    # the aiosqlite connection threads keep the process alive otherwise
+    for engine in engines:
+        if hasattr(engine, "sync_engine"):
+            await engine.dispose()
+    return failures
+
+
+def run_mode(name: str, env_overrides: dict) -> list[str]:
+    with tempfile.TemporaryDirectory() as db_dir:
+        env = dict(os.environ)
+        env.update(env_overrides)
+        env["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_dir}/primary.db"
+        env["SQLALCHEMY_REPLICA_URIS"] = ",".join(
+            f"sqlite:///{db_dir}/{replica}" for replica in REPLICAS
+        )
+        # no health checks during the check
+        env["REPLICA_CHECK_INTERVAL"] = "3600"
+        env.setdefault("LOG_LEVEL", "WARNING")
+        env.pop("RESET_DB", None)
+        env.pop("UPDATE_DB", None)
+        command = [sys.executable, "-m", "benchmarks.replicas"]
+        subprocess.run(command + [f"--seed={db_dir}"], env=env, check=True)
+        result = subprocess.run(
+            command + ["--check"],
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+    if result.returncode != 0 and not result.stdout:
+        return [f"check process failed with exit code {result.returncode}"]
+    return result.stdout.splitlines()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="read replica routing check")
+    parser.add_argument("--mode", action="append", choices=MODES)
+    # internal, the seed and check processes of a mode
+    parser.add_argument("--seed", help=argparse.SUPPRESS)
+    parser.add_argument("--check", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.seed:
+        seed(args.seed)
+        return 0
+    if args.check:
+        failures = asyncio.run(check())
+        for failure in failures:
+            print(failure)
+        return 1 if failures else 0
+
+    failed = False
+    for name in args.mode or MODES:
+        failures = run_mode(name, MODES[name])
+        print(f"{name}: {'failed' if failures else 'ok'}")
+        for failure in failures:
+            print(f"  {failure}")
+        failed = failed or bool(failures)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+# benchmark of the list response serialization paths, at 10/100/1000 todos
+# and users per page, on an in-memory sqlite db:
+#
+# - response_model: orm objects, validated by the response model and encoded
+#   with the stdlib json module, as fastapi does by default
+# - type_adapter: orm objects, validated and encoded to json by the
+#   precompiled schemas.TodoReadList and schemas.UserReadList adapters
+# - fast_json: TodoRead and UserRead column rows encoded with orjson
+#   (Config.FAST_JSON)
+#
+# run from the project root with `python -m benchmarks.serialization`
+
+import json
+import statistics
+import timeit
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+from app import crud, fast_json, schemas
+from app.models import Base, Todo, User
+
+PAGE_SIZES = (10, 100, 1000)
+REPEAT = 5
+
+
+def response_model(adapter, rows: list) -> bytes:
+    content = adapter.dump_python(
+        adapter.validate_python(rows, from_attributes=True), mode="json"
+    )
+    # JSONResponse.render
+    return json.dumps(
+        content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def type_adapter(adapter, rows: list) -> bytes:
+    return adapter.dump_json(adapter.validate_python(rows, from_attributes=True))
+
+
+# list name: paths, each loading and encoding a page of `limit` items
+LISTS = {
+    "todos": {
+        "response_model": lambda db, limit: response_model(
+            schemas.TodoReadList, crud.get_todos(db, limit=limit)
+        ),
+        "type_adapter": lambda db, limit: type_adapter(
+            schemas.TodoReadList, crud.get_todos(db, limit=limit)
+        ),
+        "fast_json": lambda db, limit: fast_json.rows_json(
+            crud.get_todos_rows(db, limit=limit), fast_json.TODO_READ_FIELDS
+        ),
+    },
+    "users": {
+        "response_model": lambda db, limit: response_model(
+            schemas.UserReadList, crud.get_users(db, limit=limit)
+        ),
+        "type_adapter": lambda db, limit: type_adapter(
+            schemas.UserReadList, crud.get_users(db, limit=limit)
+        ),
+        "fast_json": lambda db, limit: fast_json.rows_json(
+            crud.get_users_rows(db, limit=limit), fast_json.USER_READ_FIELDS
+        ),
+    },
+}
+
+
+def setup_db():
+    engine = create_engine(
+        "sqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    Base.metadata.create_all(engine)
+    with Session(engine) as db:
+        owner_id = db.execute(
+            insert(User).returning(User.id),
+            {"email": "bench@example.com", "hashed_password": "x"},
+        ).scalar_one()
+        db.execute(
+            insert(Todo),
+            [
+                {"text": f"todo {i}", "completed": i % 2 == 0, "owner_id": owner_id}
+                for i in range(max(PAGE_SIZES))
+            ],
+        )
+        db.execute(
+            insert(User),
+            [
+                {"email": f"user{i}@example.com", "hashed_password": "x"}
+                for i in range(max(PAGE_SIZES) - 1)
+            ],
+        )
+        db.commit()
+    return engine
+
+
+# a session per call, like a request
+def call(engine, path, limit: int) -> bytes:
+    with Session(engine) as db:
+        return path(db, limit)
+
+
+def run() -> None:
+    engine = setup_db()
+    print(f"{'list':<6} {'items':>6} {'path':<16} {'ms/page':>9} {'speedup':>8}")
+    for list_name, paths in LISTS.items():
+        for limit in PAGE_SIZES:
+            # all paths return the same json
+            outputs = {
+                json.dumps(json.loads(call(engine, p, limit))) for p in paths.values()
+            }
+            assert len(outputs) == 1
+            number = max(1, 2000 // limit)
+            baseline = None
+            for name, path in paths.items():
+                timings = timeit.repeat(
+                    lambda: call(engine, path, limit), number=number, repeat=REPEAT
+                )
+                ms = statistics.median(timings) / number * 1000
+                baseline = baseline or ms
+                print(
+                    f"{list_name:<6} {limit:>6} {name:<16} {ms:>9.3f} "
+                    f"{baseline / ms:>7.1f}x"
+                )
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,200 @@
+# read/write throughput of 4 worker processes sharing one sqlite file, as
+# with `uvicorn --workers 4`, with the sqlite defaults (rollback journal), the
+# tuned pragmas (WAL, Config.SQLITE_WAL) and the tuned pragmas with the single
+# writer queue (Config.SQLITE_WRITE_QUEUE).
+#
+# each worker drives the app in-process with httpx, with concurrent clients
+# sending a mix of todo reads (get, list) and writes (create, update), and
+# counts the responses and the errors, eg. 500 of "database is locked".
+#
+#   python -m benchmarks.sqlite_concurrency
+#   python -m benchmarks.sqlite_concurrency --workers 8 --write-ratio 0.5
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+MODES = {
+    "rollback journal": {"SQLITE_WAL": "0", "SQLITE_WRITE_QUEUE": "0"},
+    "wal": {"SQLITE_WAL": "1", "SQLITE_WRITE_QUEUE": "0"},
+    "wal + write queue": {"SQLITE_WAL": "1", "SQLITE_WRITE_QUEUE": "1"},
+}
+# seconds for the workers to start and log in before the measure
+START_DELAY = 5
+
+
+def seed(users: int, todos: int) -> None:
+    from app.db import engine
+    from app.db_migration import seed_data
+    from app.models import Base
+
+    Base.metadata.create_all(engine)
+    seed_data(engine, users, todos, seed=1)
+
+
+async def client_loop(
+    client: httpx.AsyncClient,
+    headers: dict,
+    todos: int,
+    write_ratio: float,
+    deadline: float,
+    rng: random.Random,
+    stats: dict,
+) -> None:
+    while time.time() < deadline:
+        write = rng.random() < write_ratio
+        id = rng.randrange(1, todos + 1)
+        started = time.perf_counter()
+        if write and rng.random() < 0.5:
+            response = await client.post(
+                "/api/v1/todos/", json={"text": "benchmark todo"}, headers=headers
+            )
+        elif write:
+            todo = {"id": id, "text": "updated todo", "completed": True}
+            response = await client.put(
+                f"/api/v1/todos/{id}", json=todo, headers=headers
+            )
+        elif rng.random() < 0.5:
+            response = await client.get(f"/api/v1/todos/{id}")
+        else:
+            response = await client.get("/api/v1/todos/?limit=20")
+        kind = "writes" if write else "reads"
+        if response.status_code >= 400:
+            stats["errors"] += 1
+        else:
+            stats[kind] += 1
+            stats[f"{kind}_ms"].append((time.perf_counter() - started) * 1000)
+
+
+async def worker(args) -> dict:
+    from app.main import app
+
+    stats = {"reads": 0, "writes": 0, "errors": 0, "reads_ms": [], "writes_ms": []}
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://benchmark"
+    ) as client:
+        response = await client.post(
+            "/auth/token",
+            data={"username": f"user{args.worker}@example.com", "password": "secret"},
+        )
+        response.raise_for_status()
+        headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+        await asyncio.sleep(max(0, args.start_at - time.time()))
+        deadline = args.start_at + args.seconds
+        await asyncio.gather(
+            *(
+                client_loop(
+                    client,
+                    headers,
+                    args.todos,
+                    args.write_ratio,
+                    deadline,
+                    random.Random(args.worker * 1000 + i),
+                    stats,
+                )
+                for i in range(args.concurrency)
+            )
+        )
+    return stats
+
+
+def run_mode(name: str, env_overrides: dict, args) -> dict:
+    with tempfile.TemporaryDirectory() as db_dir:
+        env = dict(os.environ)
+        env.update(env_overrides)
+        env["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_dir}/concurrency.db"
+        env.setdefault("LOG_LEVEL", "WARNING")
+        env.pop("RESET_DB", None)
+        env.pop("UPDATE_DB", None)
+        command = [sys.executable, "-m", "benchmarks.sqlite_concurrency"]
+        options = [
+            f"--users={args.users}",
+            f"--todos={args.todos}",
+            f"--seconds={args.seconds}",
+            f"--concurrency={args.concurrency}",
+            f"--write-ratio={args.write_ratio}",
+        ]
+        subprocess.run(command + options + ["--seed-only"], env=env, check=True)
+        start_at = time.time() + START_DELAY
+        processes = [
+            subprocess.Popen(
+                command + options + [f"--worker={i}", f"--start-at={start_at}"],
+                env=env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True,
+            )
+            for i in range(args.workers)
+        ]
+        results = [json.loads(p.communicate()[0].splitlines()[-1]) for p in processes]
+
+    reads_ms = [ms for r in results for ms in r["reads_ms"]]
+    writes_ms = [ms for r in results for ms in r["writes_ms"]]
+
+    def p95(values):
+        if len(values) < 2:
+            return float("nan")
+        return statistics.quantiles(values, n=20, method="inclusive")[-1]
+
+    return {
+        "mode": name,
+        "reads_per_second": sum(r["reads"] for r in results) / args.seconds,
+        "writes_per_second": sum(r["writes"] for r in results) / args.seconds,
+        "errors": sum(r["errors"] for r in results),
+        "read_p95_ms": p95(reads_ms),
+        "write_p95_ms": p95(writes_ms),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="sqlite multi-worker benchmark")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--todos", type=int, default=10_000)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--concurrency", type=int, default=16, help="per worker")
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    parser.add_argument("--mode", action="append", choices=MODES)
+    # internal, the seed and worker processes of a mode
+    parser.add_argument("--seed-only", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--start-at", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.seed_only:
+        seed(args.users, args.todos)
+        return 0
+    if args.worker is not None:
+        print(json.dumps(asyncio.run(worker(args))))
+        return 0
+
+    print(
+        f"{args.workers} workers x {args.concurrency} clients, "
+        f"{args.write_ratio:.0%} writes, {args.seconds:.0f}s per mode"
+    )
+    print(
+        f"{'mode':<20} {'reads/s':>9} {'writes/s':>9} {'errors':>7} "
+        f"{'read p95 ms':>12} {'write p95 ms':>13}"
+    )
+    for name in args.mode or MODES:
+        r = run_mode(name, MODES[name], args)
+        print(
+            f"{r['mode']:<20} {r['reads_per_second']:>9.1f} "
+            f"{r['writes_per_second']:>9.1f} {r['errors']:>7} "
+            f"{r['read_p95_ms']:>12.1f} {r['write_p95_ms']:>13.1f}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+# cold start benchmark of a worker process, median of fresh processes:
+#
+# - import_ms: `import app.main`, as the worker imports the app
+# - first_request_ms: lifespan start up and the first GET /health
+# - ready_ms: from process spawn to the first response, interpreter start up
+#   included
+#
+# fails (exit code 1) when a median is over its budget, or when one of the
+# LAZY_MODULES, deferred to their first use, is imported by `import app.main`.
+# runs in CI, and locally from the project root with
+#
+#   python -m benchmarks.startup
+#   python -m benchmarks.startup --importtime  # slowest imports
+#
+# the db migration (RESET_DB, UPDATE_DB) is not part of the measure.
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+# budgets of a ci runner, about twice the time of a laptop
+IMPORT_BUDGET_MS = 2500
+FIRST_REQUEST_BUDGET_MS = 500
+READY_BUDGET_MS = 3500
+
+# heavy modules imported on first use, out of the start up
+LAZY_MODULES = ("jose", "passlib", "jinja2")
+
+
+async def first_request(app) -> None:
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://startup"
+        ) as client:
+            response = await client.get("/health")
+            response.raise_for_status()
+
+
+# runs in the measured process
+def child() -> None:
+    started = time.perf_counter()
+    from app.main import app
+
+    imported = time.perf_counter()
+    lazy_imported = [name for name in LAZY_MODULES if name in sys.modules]
+    asyncio.run(first_request(app))
+    print(
+        json.dumps(
+            {
+                "import_ms": (imported - started) * 1000,
+                "first_request_ms": (time.perf_counter() - imported) * 1000,
+                "lazy_imported": lazy_imported,
+            }
+        ),
+        flush=True,
+    )
+
+
+def child_env(db_dir: str) -> dict:
+    env = dict(os.environ)
+    env["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_dir}/startup.db"
+    env.setdefault("LOG_LEVEL", "WARNING")
+    env.pop("RESET_DB", None)
+    env.pop("UPDATE_DB", None)
+    return env
+
+
+def measure(env: dict) -> dict:
+    started = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.startup", "--child"],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    # the process exit is not part of the start up
+    result["ready_ms"] = (time.perf_counter() - started) * 1000
+    return result
+
+
+# self time of the slowest modules imported by app.main
+def print_importtime(env: dict, top: int = 20) -> None:
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.main"],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:") :].split("|")
+        rows.append((int(self_us), int(cumulative_us), module.strip()))
+    print(f"{'self ms':>8} {'cumul ms':>9}  module")
+    for self_us, cumulative_us, module in sorted(rows, reverse=True)[:top]:
+        print(f"{self_us / 1000:>8.1f} {cumulative_us / 1000:>9.1f}  {module}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="worker cold start benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--import-budget-ms", type=float, default=IMPORT_BUDGET_MS)
+    parser.add_argument(
+        "--first-request-budget-ms", type=float, default=FIRST_REQUEST_BUDGET_MS
+    )
+    parser.add_argument("--ready-budget-ms", type=float, default=READY_BUDGET_MS)
+    parser.add_argument("--importtime", action="store_true")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child()
+        return 0
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        env = child_env(db_dir)
+        if args.importtime:
+            print_importtime(env)
+            return 0
+        results = [measure(env) for _ in range(args.runs)]
+
+    failures = []
+    budgets = {
+        "import_ms": args.import_budget_ms,
+        "first_request_ms": args.first_request_budget_ms,
+        "ready_ms": args.ready_budget_ms,
+    }
+    for key, budget in budgets.items():
+        median = statistics.median(result[key] for result in results)
+        print(f"{key:<17} {median:>8.1f} ms  (budget {budget:.0f} ms)")
+        if median > budget:
+            failures.append(f"{key} {median:.1f}ms over budget {budget:.0f}ms")
+    lazy_imported = results[0]["lazy_imported"]
+    if lazy_imported:
+        failures.append(f"imported at start up: {', '.join(lazy_imported)}")
+
+    for failure in failures:
+        print(f"FAILED {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
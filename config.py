@@ -8,6 +8,21 @@ load_dotenv(os.path.join(basedir, ".env.sample"))
 logger = logging.getLogger(__name__)
 
 
+# parse boolean-like env vars, eg. "1", "true", "yes" are all truthy
+def env_flag(name: str, default: str = "0") -> bool:
+    return os.environ.get(name, default).strip().lower() in ("1", "true", "yes", "on")
+
+
+# the async driver url of a database url: aiosqlite for sqlite, asyncpg for
+# postgresql
+def async_database_uri(uri: str) -> str:
+    return (
+        uri.replace("sqlite:", "sqlite+aiosqlite:", 1)
+        .replace("postgresql+psycopg2:", "postgresql:", 1)
+        .replace("postgresql:", "postgresql+asyncpg:", 1)
+    )
+
+
 class Config(object):
     LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
     logger.setLevel(LOG_LEVEL)
@@ -20,13 +35,105 @@ class Config(object):
     ) or "sqlite:///" + os.path.join(basedir, "sqlite.db")
     logger.info(f"SQLALCHEMY_DATABASE_URI: {SQLALCHEMY_DATABASE_URI}")
 
+    # log every sql statement (engine echo), for local development only
+    SQLALCHEMY_ECHO = env_flag("SQLALCHEMY_ECHO")
+    logger.info(f"SQLALCHEMY_ECHO: {SQLALCHEMY_ECHO}")
+
+    # run api routes natively on the event loop with an async engine/session
+    # the async driver url is derived from SQLALCHEMY_DATABASE_URI by default:
+    # aiosqlite for sqlite, asyncpg for postgresql
+    SQLALCHEMY_ASYNC = env_flag("SQLALCHEMY_ASYNC")
+    logger.info(f"SQLALCHEMY_ASYNC: {SQLALCHEMY_ASYNC}")
+
+    SQLALCHEMY_ASYNC_DATABASE_URI = os.environ.get(
+        "SQLALCHEMY_ASYNC_DATABASE_URI", ""
+    ) or async_database_uri(SQLALCHEMY_DATABASE_URI)
+    logger.info(f"SQLALCHEMY_ASYNC_DATABASE_URI: {SQLALCHEMY_ASYNC_DATABASE_URI}")
+
+    # comma separated read replica urls of the primary database, the reads of
+    # GET requests are spread over them, see app/replicas.py
+    SQLALCHEMY_REPLICA_URIS = [
+        uri.strip()
+        for uri in os.environ.get("SQLALCHEMY_REPLICA_URIS", "").split(",")
+        if uri.strip()
+    ]
+    logger.info(f"SQLALCHEMY_REPLICA_URIS: {len(SQLALCHEMY_REPLICA_URIS)} replicas")
+
+    # the async driver urls of the replicas, for async db mode
+    SQLALCHEMY_ASYNC_REPLICA_URIS = [
+        async_database_uri(uri) for uri in SQLALCHEMY_REPLICA_URIS
+    ]
+
+    # seconds a client reads from the primary after a write, longer than the
+    # usual replication lag
+    REPLICA_STICKY_SECONDS = int(os.environ.get("REPLICA_STICKY_SECONDS", 5))
+    logger.info(f"REPLICA_STICKY_SECONDS: {REPLICA_STICKY_SECONDS}")
+
+    # seconds between the health checks of the replicas
+    REPLICA_CHECK_INTERVAL = float(os.environ.get("REPLICA_CHECK_INTERVAL", 5))
+    logger.info(f"REPLICA_CHECK_INTERVAL: {REPLICA_CHECK_INTERVAL}")
+
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     logger.info(f"SQLALCHEMY_TRACK_MODIFICATIONS: {SQLALCHEMY_TRACK_MODIFICATIONS}")
 
+    # connection pool tuning, applies to both sync and async engines
+    # size the pool per worker process: replicas * workers * (size + overflow)
+    # must stay below the database max_connections
+    DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+    logger.info(f"DB_POOL_SIZE: {DB_POOL_SIZE}")
+
+    DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+    logger.info(f"DB_MAX_OVERFLOW: {DB_MAX_OVERFLOW}")
+
+    # seconds to wait for a connection checkout before raising TimeoutError
+    DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+    logger.info(f"DB_POOL_TIMEOUT: {DB_POOL_TIMEOUT}")
+
+    # seconds after which a connection is recycled, -1 to disable
+    DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+    logger.info(f"DB_POOL_RECYCLE: {DB_POOL_RECYCLE}")
+
+    # test connections for liveness on checkout, eg. after db restart/failover
+    DB_POOL_PRE_PING = env_flag("DB_POOL_PRE_PING", "1")
+    logger.info(f"DB_POOL_PRE_PING: {DB_POOL_PRE_PING}")
+
+    # sqlite tuning, see app/db.py: WAL journal, synchronous=NORMAL, memory
+    # mapped reads, page cache and busy timeout, 0 to keep the sqlite defaults
+    SQLITE_WAL = env_flag("SQLITE_WAL", "1")
+    logger.info(f"SQLITE_WAL: {SQLITE_WAL}")
+
+    SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+    logger.info(f"SQLITE_MMAP_SIZE: {SQLITE_MMAP_SIZE}")
+
+    SQLITE_CACHE_SIZE_KIB = int(os.environ.get("SQLITE_CACHE_SIZE_KIB", 64 * 1024))
+    logger.info(f"SQLITE_CACHE_SIZE_KIB: {SQLITE_CACHE_SIZE_KIB}")
+
+    SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000))
+    logger.info(f"SQLITE_BUSY_TIMEOUT_MS: {SQLITE_BUSY_TIMEOUT_MS}")
+
+    # run the todo writes of a worker on one writer thread, committed in groups
+    # of up to SQLITE_WRITE_BATCH writes, see app/write_queue.py
+    SQLITE_WRITE_QUEUE = env_flag("SQLITE_WRITE_QUEUE")
+    logger.info(f"SQLITE_WRITE_QUEUE: {SQLITE_WRITE_QUEUE}")
+
+    SQLITE_WRITE_BATCH = int(os.environ.get("SQLITE_WRITE_BATCH", 64))
+    logger.info(f"SQLITE_WRITE_BATCH: {SQLITE_WRITE_BATCH}")
+
     # secret key for signing cookies (web) and tokens (api)
     SECRET_KEY = os.getenv("SECRET_KEY") or "TOP SECRET"
     logger.info(f"SECRET_KEY: {SECRET_KEY[:8]}...")
 
+    # web session store, "cookie" keeps signed session data in the cookie,
+    # "sqlite" keeps it server-side in a local sqlite file shared by the
+    # worker processes of one host, the cookie only carries the session id
+    SESSION_STORE = os.environ.get("SESSION_STORE", "cookie")
+    logger.info(f"SESSION_STORE: {SESSION_STORE}")
+
+    SESSION_STORE_PATH = os.environ.get("SESSION_STORE_PATH", "") or os.path.join(
+        basedir, "sessions.db"
+    )
+    logger.info(f"SESSION_STORE_PATH: {SESSION_STORE_PATH}")
+
     API_PREFIX = os.environ.get("API_PREFIX", "/api/v1")
     logger.info(f"API_PREFIX: {API_PREFIX}")
 
@@ -36,5 +143,105 @@ class Config(object):
     ACCESS_TOKEN_EXPIRE_MINUTES = 15
     logger.info(f"ACCESS_TOKEN_EXPIRE_MINUTES: {ACCESS_TOKEN_EXPIRE_MINUTES}")
 
+    # bcrypt hashing and verification run on a dedicated thread pool, off the
+    # event loop and the starlette thread pool. requests beyond the max number
+    # of pending hash jobs are rejected with 503 instead of queueing up
+    PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 2))
+    logger.info(f"PASSWORD_HASH_WORKERS: {PASSWORD_HASH_WORKERS}")
+
+    PASSWORD_HASH_MAX_PENDING = int(os.environ.get("PASSWORD_HASH_MAX_PENDING", 64))
+    logger.info(f"PASSWORD_HASH_MAX_PENDING: {PASSWORD_HASH_MAX_PENDING}")
+
+    # seconds to cache successful password verifications, 0 to disable
+    AUTH_CACHE_TTL = int(os.environ.get("AUTH_CACHE_TTL", 0))
+    logger.info(f"AUTH_CACHE_TTL: {AUTH_CACHE_TTL}")
+
+    # seconds to cache token and session authenticated users per worker, which
+    # saves the user query per authenticated call, 0 to disable. other workers
+    # serve a changed or deleted user until the ttl expires
+    PRINCIPAL_CACHE_TTL = int(os.environ.get("PRINCIPAL_CACHE_TTL", 0))
+    logger.info(f"PRINCIPAL_CACHE_TTL: {PRINCIPAL_CACHE_TTL}")
+
+    # seconds to cache the global todo stats per worker, 0 to disable, the
+    # stats of a user are not cached, see app/stats.py
+    STATS_CACHE_TTL = int(os.environ.get("STATS_CACHE_TTL", 10))
+    logger.info(f"STATS_CACHE_TTL: {STATS_CACHE_TTL}")
+
+    # days to keep the tombstones of deleted todos for GET /todos/changes,
+    # pruned by `python -m app.sync`, see app/sync.py
+    SYNC_TOMBSTONE_DAYS = float(os.environ.get("SYNC_TOMBSTONE_DAYS", 30))
+    logger.info(f"SYNC_TOMBSTONE_DAYS: {SYNC_TOMBSTONE_DAYS}")
+
+    # max changes per GET /todos/changes page (?limit=)
+    SYNC_CHANGES_LIMIT = int(os.environ.get("SYNC_CHANGES_LIMIT", 1000))
+    logger.info(f"SYNC_CHANGES_LIMIT: {SYNC_CHANGES_LIMIT}")
+
+    # events per WebSocket and SSE subscription of todo changes, subscriptions
+    # that fall behind by more are dropped, see app/events.py
+    EVENTS_QUEUE_SIZE = int(os.environ.get("EVENTS_QUEUE_SIZE", 100))
+    logger.info(f"EVENTS_QUEUE_SIZE: {EVENTS_QUEUE_SIZE}")
+
+    # deliver todo events across worker processes with postgresql LISTEN/NOTIFY
+    EVENTS_PG_NOTIFY = env_flag("EVENTS_PG_NOTIFY")
+    logger.info(f"EVENTS_PG_NOTIFY: {EVENTS_PG_NOTIFY}")
+
     PAGINATION_LIMIT = 5
     logger.info(f"PAGINATION_LIMIT: {PAGINATION_LIMIT}")
+
+    # max number of nested todos of a user response, more are paginated with
+    # todos_next_cursor
+    NESTED_TODOS_LIMIT = int(os.environ.get("NESTED_TODOS_LIMIT", 100))
+    logger.info(f"NESTED_TODOS_LIMIT: {NESTED_TODOS_LIMIT}")
+
+    # request, db and thread pool metrics served by /metrics, see app/metrics.py
+    METRICS_ENABLED = env_flag("METRICS_ENABLED", "1")
+    logger.info(f"METRICS_ENABLED: {METRICS_ENABLED}")
+
+    # Server-Timing of the db statements of requests with a `X-Debug-SQL: 1`
+    # header or `debug_sql=1` query parameter, see app/sql_profiling.py
+    SQL_PROFILING = env_flag("SQL_PROFILING")
+    logger.info(f"SQL_PROFILING: {SQL_PROFILING}")
+
+    # log statements slower than this many milliseconds, 0 to disable
+    SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 0))
+    logger.info(f"SLOW_QUERY_MS: {SLOW_QUERY_MS}")
+
+    # seconds to wait for the migration lock held by another process at start
+    # up (RESET_DB, UPDATE_DB), before failing the start up
+    MIGRATION_LOCK_TIMEOUT = float(os.environ.get("MIGRATION_LOCK_TIMEOUT", 300))
+    logger.info(f"MIGRATION_LOCK_TIMEOUT: {MIGRATION_LOCK_TIMEOUT}")
+
+    # synthetic users and todos seeded by RESET_DB after the initial data, 0
+    # for the initial data only, see db_migration.seed_data. todos per user
+    # follow a zipf-like distribution, SEED_SKEW=0 spreads them evenly
+    SEED_USERS = int(os.environ.get("SEED_USERS", 0))
+    logger.info(f"SEED_USERS: {SEED_USERS}")
+
+    SEED_TODOS = int(os.environ.get("SEED_TODOS", 0))
+    logger.info(f"SEED_TODOS: {SEED_TODOS}")
+
+    SEED_SKEW = float(os.environ.get("SEED_SKEW", 1.0))
+    logger.info(f"SEED_SKEW: {SEED_SKEW}")
+
+    # rows fetched per server-side cursor round trip by streaming exports
+    EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE", 1000))
+    logger.info(f"EXPORT_CHUNK_SIZE: {EXPORT_CHUNK_SIZE}")
+
+    # rows per insert (and transaction) of bulk imports
+    IMPORT_CHUNK_SIZE = int(os.environ.get("IMPORT_CHUNK_SIZE", 5000))
+    logger.info(f"IMPORT_CHUNK_SIZE: {IMPORT_CHUNK_SIZE}")
+
+    # encode list responses from column rows with orjson, see app/fast_json.py
+    FAST_JSON = env_flag("FAST_JSON")
+    logger.info(f"FAST_JSON: {FAST_JSON}")
+
+    # per worker cache of serialized todo read responses, by url and etag
+    RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 1024))
+    logger.info(f"RESPONSE_CACHE_SIZE: {RESPONSE_CACHE_SIZE}")
+
+    RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", 300))
+    logger.info(f"RESPONSE_CACHE_TTL: {RESPONSE_CACHE_TTL}")
+
+    # max number of items in one batch request
+    BATCH_LIMIT = int(os.environ.get("BATCH_LIMIT", 1000))
+    logger.info(f"BATCH_LIMIT: {BATCH_LIMIT}")